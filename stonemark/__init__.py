@@ -102,17 +102,23 @@ from __future__ import print_function
 
 # imports & globals
 from abc import ABCMeta
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from itertools import count
 from aenum import Enum, Flag, auto, export
 from scription import *
 import codecs
+import io
 import re
+import sys
+import threading
 
 
 __all__ = [
         'FormatError', 'BadFormat', 'AmbiguousFormat', 'IndentError',
         'Node', 'Heading', 'Paragraph', 'List', 'ListItem', 'CodeBlock', 'BlockQuote', 'Rule',
         'Link', 'Image', 'IDLink', 'ID', 'Definition', 'Text', 'Table', 'Detail',
-        'Document',
+        'Document', 'FormatCache', 'ParseContext', 'Renderer', 'HtmlRenderer',
         ]
 
 version = 0, 3, 7, 1
@@ -129,7 +135,7 @@ class NodeType(ABCMeta):
         return "%s" % self.__name__
 
 
-ABC = NodeType('ABC', (object, ), {})
+ABC = NodeType('ABC', (object, ), {'__slots__': ()})
 
 class DocEnum(Enum):
     _init_ = 'value __doc__'
@@ -190,6 +196,7 @@ class TextType(int, Flag):
             close = open
         member.open = open
         member.close = close
+        member.whitespace = whitespace
         member.__doc__ = docstring
         member.start = start
         member.end = end
@@ -235,6 +242,25 @@ class BlankLineType(DocEnum):
     RESET           = 'may or may not indicate end of node'
 
 
+class StyleTags(dict):
+    """
+    {style bits: (start tags, end tags)} -- each combination of styles is worked
+    out the first time it is asked for
+    """
+
+    marks = BOLD, ITALIC, CODE, MONO, STRIKE, UNDERLINE, HIGHLIGHT, SUB, SUPER, FOOT_NOTE
+
+    def __missing__(self, bits):
+        start = ''
+        end = ''
+        for mark in self.marks:
+            if bits & mark._value_:
+                start = start + mark.start
+                end = mark.end + end
+        self[bits] = start, end
+        return start, end
+
+
 class FormatError(Exception):
     pass
 
@@ -252,39 +278,50 @@ class MissingLink(FormatError):
 
 class Node(ABC):
 
+    # nodes are made by the thousand, so they keep their attributes in slots; every
+    # subclass lists the attributes it adds
+    __slots__ = (
+            'parent', 'context', 'node_id', 'links', 'indent', 'stream', 'items', 'final',
+            'reset', 'status', 'children', 'sequence', 'start_line', 'end_line', 'text',
+            'start', 'end', 'html',
+            )
+
     allowed_blocks = ()
     allowed_text = PLAIN
-    text = None
-    start_line = None
-    end_line = None
     blank_line = TERMINATE
     blank_line_required = True
-    parent = None
-    children = False
     terminate_after_children = True
-    sequence = None
-    links = {}
+    nested = False
 
     def __init__(self, stream, indent=0, sequence=None, parent=None):
-        self.node_id = next(UID)
         if parent is None:
             raise TypeError('parent cannot be None')
+        self.text = None
+        self.end_line = None
+        self.status = None
+        self.children = False
+        # the html of a block in a document made with keep_html; see changed()
+        self.html = None
         self.parent = parent
-        self.links = parent.links
+        # set once here; Document.validate() checks that they agree all the way down
+        self.context = context = parent.context
+        self.node_id = context.next_id()
+        self.links = context.links
         self.indent = indent
         self.stream = stream
         self.items = []
         self.final = False
         self.reset = None
         self.sequence = sequence
+        # start and end are character offsets into the source, end not included;
+        # format() sets them for the text nodes it makes
+        self.end = None
         if stream is not None:
             self.start_line = stream.line_no
+            self.start = stream.offset + indent
         else:
             self.start_line = None
-        while not isinstance(parent, Document):
-            assert self.links is parent.links
-            parent = parent.parent
-
+            self.start = None
 
     def __repr__(self):
         items = "items=%r" % (self.items, )
@@ -299,18 +336,77 @@ class Node(ABC):
         return ""
 
     def parse(self):
+        """
+        read this node's lines from the stream, parsing the nodes in it, then
+        finalize it; return whether to keep it
+        """
+        return run_parsing(self.parsing(), self)
+
+    def parsing(self):
+        """
+        read this node's lines from the stream, yielding each node in them that is
+        still to be parsed -- run_parsing() parses it in the meantime
+
+        the lines of a nested node are parsed into blocks as they are read, through
+        a SubStream over read_lines(); any child node splits them into separate runs
+        """
+        self.reset = False
+        if not self.nested:
+            for child in self.read_lines():
+                yield child
+        else:
+            blocks = []
+            while True:
+                yield self.parse_run(blocks)
+                if self.status is not CHILD:
+                    break
+                child = self.items.pop()
+                yield child
+                blocks.append(child)
+                self.extend_to(child)
+            self.items = blocks
+
+    def parse_run(self, blocks, lines=None):
+        """
+        parse a nested node's lines, up to its end or its next child, adding the
+        blocks they make to blocks; like parsing(), yields what is still to be parsed
+        """
+        if lines is None:
+            lines = SubStream(self.read_lines())
+        if not lines:
+            return
+        doc = Document(None, context=self.context)
+        yield doc.parsing(lines)
+        for node in doc.nodes:
+            # they belong to this node, not to the Document that parsed them
+            node.parent = self
+        blocks.extend(doc.nodes)
+
+    def read_lines(self):
+        """
+        read lines until this node ends (status is END) or, when nested, until a
+        child node has been added to items, still to be parsed (status is CHILD)
+
+        when nested, each line check() adds to items is taken back out and yielded,
+        with its LineTags if they are at hand, and its offset in the source; when
+        not, each child is yielded to be parsed, as parsing() does
+        """
         items = self.items
         stream = self.stream
-        self.reset = False
-        #
+        self.status = END
         while stream:
+            added = len(items)
             line = stream.current_line.rstrip()
+            start = stream.offset + self.indent
             if not line:
                 if self.blank_line is TERMINATE:
                     status = END
                 elif self.blank_line is INCLUDE:
-                    items.append(line)
                     stream.skip_line()
+                    if self.nested:
+                        yield line, None, start
+                    else:
+                        items.append(line)
                     continue
                 elif self.blank_line is RESET:
                     self.reset = True
@@ -327,10 +423,11 @@ class Node(ABC):
                         # maybe raise, maybe okay
                         self.premature_end('%s%s' % (ws, line))
                 else:
-                    status = self.check(line)
+                    tags = stream.tags(self.indent)
+                    status = self.check(line, tags)
             if status is SAME and self.children and self.terminate_after_children:
                 raise AmbiguousFormat('ambiguous format at line %d:\n%r' % (stream.line_no, line))
-            if status in (CONCLUDE, END):
+            if status is END or status is CONCLUDE:
                 self.reset = False
                 self.end_line = self.end_line or stream.line_no
                 if status is END:
@@ -338,54 +435,71 @@ class Node(ABC):
                 elif status is CONCLUDE:
                     # line was added by check(), skip the line here
                     stream.skip_line()
-                try:
-                    keep = self.finalize()
-                except FormatError:
-                    raise
-                except Exception:
-                    raise
-                break
+                    self.end = start + len(line)
             elif status is SAME:
                 # line was added by check(); reset reset and end_line and skip line
                 stream.skip_line()
                 self.reset = False
                 self.end_line = None
+                self.end = start + len(line)
             elif status is CHILD:
                 self.children = True
                 # self.reset = False
                 self.end_line = None
                 for child in self.allowed_blocks:
-                    match, offset, kwds = child.is_type(stream.last_line, line, stream.peek_line())
+                    match, offset, kwds = child.is_type(stream.last_line, line, stream.peek_line(), tags)
                     if match:
                         new_indent = self.indent + offset
                         child = child(stream=stream, indent=new_indent, parent=self, **kwds)
                         items.append(child)
-                        child.parse()
                         break
                 else:
                     # no valid child type found
                     raise BadFormat('failed match at line %d\n%r' % (stream.line_no, line))
+                if self.nested:
+                    self.status = CHILD
+                    return
+                yield child
+                self.extend_to(child)
             else:
                 raise Exception('unknown status: %r' % (status, ))
+            if self.nested and added < len(items):
+                texts = items[added:]
+                del items[added:]
+                for text in texts:
+                    # text is usually the end of line, so its tags can be had from line's
+                    if line.endswith(text):
+                        yield text, tags.at(len(line) - len(text)), start + len(line) - len(text)
+                    else:
+                        yield text, None, start
+            if status is END or status is CONCLUDE:
+                break
         else:
-            keep = self.finalize()
             self.reset = False
-        return keep
+
+    def extend_to(self, child):
+        """
+        make this node's span take in child's
+        """
+        if child.end is not None:
+            self.end = child.end
 
     def premature_end(self, line):
         # by default, that's an error
         raise IndentError('bad indent at line %d (missing blank line above?)' % self.stream.line_no)
 
-    def check(self, line):
+    def check(self, line, tags):
         """
         return END, SAME, CHILD, or CONCLUDE depending on nature of next line
+
+        line has had this node's indentation removed, and tags are its LineTags
         """
         raise NotImplementedError
 
     @classmethod
-    def is_type(cls, last_line, line, next_line):
+    def is_type(cls, last_line, line, next_line, tags):
         """
-        checks if next line(s) are this node's type
+        checks if next line(s) are this node's type (tags are line's LineTags)
 
         returns True, additional indent, {any keywords for __init__}; or
                 NO_MATCH
@@ -399,37 +513,64 @@ class Node(ABC):
         any final processing for the node goes here
         """
         self.final = True
+        self.release()
         return True
 
+    def release(self):
+        """
+        drop what only parsing needed, such as the stream (which keeps the source)
+        """
+        self.stream = None
+        self.reset = None
+        self.status = None
+
+    def changed(self):
+        """
+        call after changing this node (its items, links, or other attributes) to
+        drop the html kept for it, and for every node it is in -- only needed in a
+        document made with keep_html, which otherwise goes on rendering the old html
+        """
+        node = self
+        while isinstance(node, Node):
+            node.html = None
+            node = node.parent
+
     def get_child_node():
         pass
 
-    def to_html(self):
-        raise NotImplementedError
+    def to_html(self, compact=False):
+        """
+        return this node's html as one string (see HtmlRenderer)
+        """
+        html = []
+        HtmlRenderer(html.append, compact).render(self)
+        return ''.join(html)
 
 
 class Heading(Node):
+    # the same slots as Paragraph, which can turn into a Heading
+    __slots__ = 'level', 'possible_header', 'marks'
     type = HEADING
     allowed_text = ALL_TEXT
-    level = None
     blank_line_required = False
 
     def __init__(self, level=None, **kwds):
         super(Heading, self).__init__(**kwds)
         self.level = level
         self.text = level
+        self.marks = []
 
     def _repr(self):
         return 'level=%r, text=%r' % (self.level, self.text)
 
-    def check(self, line):
+    def check(self, line, tags):
         # this is only called when handling a level 1 header
         if self.text == self.level:
             self.text = None
             return SAME
-        chars = set(line)
+        mark_line(self, line, 0)
         self.items.append(line)
-        if len(chars) == 1 and len(line) >= 3 and chars.pop() == '=':
+        if tags.kinds & TITLE_LINE and not tags.spaces:
             return CONCLUDE
         return SAME
 
@@ -453,85 +594,76 @@ class Heading(Node):
                 self.level = fourth
             else:
                 raise Exception('unknown header character: %r' % ch)
-        self.items = format(self.items, allowed_styles=self.allowed_text, parent=self)
+        self.items = format(self.items, allowed_styles=self.allowed_text, parent=self, marks=self.marks)
+        self.marks = None
         if self.parent.first_header_is_title and self.level == first:
             self.parent.title = re.sub('<[^>]*>','', self.to_html()).strip()
         return super(Heading, self).finalize()
 
     @classmethod
-    def is_type(cls, last_line, line, next_line):
-        chars = set(line.strip())
-        if len(chars) == 1 and len(line) >= 3 and chars.pop() == '=':
+    def is_type(cls, last_line, line, next_line, tags):
+        if tags.kinds & TITLE_LINE:
             return True, 0, {'level': 'first'}
         return NO_MATCH
 
-    def to_html(self):
-        start = '<h%d>' % self.level
-        end = '</h%d>' % self.level
-        result = []
-        for txt in self.items:
-            result.append(txt.to_html())
-        return '%s%s%s' % (start, ''.join(result), end)
-
 
 class Paragraph(Node):
+    __slots__ = 'level', 'possible_header', 'marks'
     type = PARAGRAPH
     allowed_text = ALL_TEXT
 
     def __init__(self, possible_header=True, **kwds):
         super(Paragraph, self).__init__(**kwds)
         self.possible_header = possible_header
+        # where each line starts, in the joined text and in the source
+        self.marks = []
 
-    def check(self, line=0):
-        if self.items:
-            # paragraph may have ended
-            for regex in UL, OL, CB, BQ, FCB, DTLS, DTLD:
-                if match(regex, line):
-                    # paragraph has ended, new block has started
-                    return END
-        if match(HD, line):
+    def check(self, line, tags):
+        if self.items and tags.kinds & PARAGRAPH_ENDS:
+            # paragraph has ended, new block has started
+            return END
+        if tags.kinds & UNDERLINE_LINE:
             # either the ending paragraph is really a header,
             # or we have a horizontal rule between blocks;
             # multiple lines in the paragraph means horizontal rule;
             # no preceding blank line before the block means horizontal rule;
             # otherwise, single line in paragraph means header
             if len(self.items) == 1 and self.possible_header:
+                mark_line(self, line, 0)
                 self.items.append(line)
                 return CONCLUDE
             else:
                 return END
         if self.items and isinstance(self.items[-1], str) and self.items[-1].endswith('-'):
+            mark_line(self, line, -1)
             self.items[-1] = self.items[-1][:-1] + line
         elif self.items:
+            mark_line(self, line, 1)
             self.items.append(' '+line)
         else:
+            mark_line(self, line, 0)
             self.items.append(line)
         return SAME
 
     @classmethod
-    def is_type(cls, last_line, line, next_line):
-        if not line.strip() or not line[:1].strip():
+    def is_type(cls, last_line, line, next_line, tags):
+        if not tags.kinds & TEXT_LINE:
             return NO_MATCH
         return True, 0, {'possible_header': not bool(last_line.strip())}
 
     def finalize(self):
-        if match(HD, self.items[-1]) and self.possible_header:
+        if HEADING_UNDERLINE.match(self.items[-1]) and self.possible_header:
+            self.level = None
             self.__class__ = Heading
             return self.finalize()
         else:
-            self.items = format(self.items, allowed_styles=self.allowed_text, parent=self)
+            self.items = format(self.items, allowed_styles=self.allowed_text, parent=self, marks=self.marks)
+            self.marks = None
         return super(Paragraph, self).finalize()
 
-    def to_html(self):
-        start = '<p>'
-        end = '</p>'
-        result = []
-        for txt in self.items:
-            result.append(txt.to_html())
-        return '%s%s%s' % (start, ''.join(result), end)
-
 
 class CodeBlock(Node):
+    __slots__ = 'block_type', 'language', 'attrs'
     type = CODEBLOCK
     allowed_text = PLAIN
     blank_line = INCLUDE
@@ -572,7 +704,7 @@ class CodeBlock(Node):
             new_attrs.append(a[1:])
         self.attrs = ' '.join(new_attrs)
 
-    def check(self, line):
+    def check(self, line, tags):
         if self.block_type == 'indented':
             self.items.append(line)
             return SAME
@@ -586,13 +718,12 @@ class CodeBlock(Node):
             return SAME
 
     @classmethod
-    def is_type(cls, last_line, line, next_line):
-        if match(FCB, line):
-            indent, block_type, attrs = match().groups()
-            indent = indent and len(indent) or 0
+    def is_type(cls, last_line, line, next_line, tags):
+        if tags.kinds & FENCE_LINE:
+            indent, block_type, attrs = tags.matches[FENCE_LINE].groups()
             attrs = attrs.strip()
-            return True, indent, {'block_type': block_type, 'attrs': attrs}
-        if match(CB, line):
+            return True, tags.spaces, {'block_type': block_type, 'attrs': attrs}
+        if tags.kinds & CODE_LINE:
             return True, 4, {'block_type': 'indented', 'attrs': None}
         return NO_MATCH
 
@@ -605,26 +736,20 @@ class CodeBlock(Node):
                 raise BadFormat('missing code block fence %r at line %d' % (self.block_type, self.end_line))
             self.items.pop()
             self.items.pop(0)
+        # kept as one string: a string per line costs more than the text in it
+        self.items = ['\n'.join(self.items)]
         return super(CodeBlock, self).finalize()
 
-    def to_html(self):
-        pre = '<pre>'
-        code = '<code>'
-        if self.attrs:
-            pre = '<pre class="%s">' % self.attrs
-        if self.language:
-            code = '<code class="language-%s">' % self.language
-        start = '%s%s' % (pre, code)
-        end = '</code></pre>'
-        return start + escape('\n'.join(self.items)) + end
-
 
 class Image(Node):
+    __slots__ = 'title', 'image_url', 'marker', 'link_url'
     type = IMAGE
     allowed_text = ALL_TEXT
 
     def __init__(self, title, text, image_url, marker=None, link_url=None, **kwds):
         super(Image, self).__init__(**kwds)
+        # an image is its one line, and the alt text is formatted before that line is read
+        self.end = self.stream.offset + len(self.stream.current_line.rstrip())
         self.items = format(text, allowed_styles=self.allowed_text, parent=self)
         self.title = title or ''
         self.image_url = image_url.strip()
@@ -633,39 +758,23 @@ class Image(Node):
         if marker is not None:
             self.links.setdefault(marker, []).append(self)
 
-    def check(self, line):
+    def check(self, line, tags):
         return CONCLUDE
 
     @classmethod
-    def is_type(cls, last_line, line, next_line):
-        if match(IMAGE_LINK, line):
-            alt_text, url, title = match().groups()
-            return True, 0, {'text':alt_text, 'title':title, 'image_url':url}
-        elif match(IMAGE_LINK_DIRECT, line):
-            alt_text, url, title, link = match().groups()
-            return True, 0, {'text':alt_text, 'title':title, 'image_url':url, 'link_url':link}
-        elif match(IMAGE_LINK_REFERENCE, line):
-            alt_text, url, title, ref = match().groups()
-            return True, 0, {'text':alt_text, 'title':title, 'image_url':url, 'marker':ref}
+    def is_type(cls, last_line, line, next_line, tags):
+        if tags.kinds & IMAGE_LINE:
+            found = tags.matches[IMAGE_LINE].groupdict()
+            kwds = {'text':found['alt_text'], 'title':found['title'], 'image_url':found['url']}
+            if 'link' in found:
+                kwds['link_url'] = found['link']
+            elif 'ref' in found:
+                kwds['marker'] = found['ref']
+            return True, 0, kwds
         return NO_MATCH
 
-    def to_html(self):
-        alt_text = []
-        for txt in self.items:
-            alt_text.append(txt.to_html())
-        alt_text = ''.join(alt_text)
-        if alt_text:
-            alt_text = 'alt="%s"' % alt_text
-        title = self.title
-        if title:
-            title = 'title=%s' % title
-        attrs = ('%s %s' % (title, alt_text)).strip()
-        if self.link_url is None:
-            return '\n<div><img src="%s" %s></div>\n' % (self.image_url, attrs)
-        else:
-            return '\n<div><a href="%s"><img src="%s" %s></a></div>\n' % (self.link_url, self.image_url, attrs)
-
 class List(Node):
+    __slots__ = 'marker', 'list_type', 'regex'
     type = O_LIST | U_LIST
     allowed_blocks = ()             # ListItem added after definition
     blank_line = RESET
@@ -681,13 +790,14 @@ class List(Node):
         else:
             self.regex = OL
 
-    def check(self, line):
-        if not match(self.regex, line):
-            return END
+    def check(self, line, tags):
         if self.list_type is U_LIST:
-            marker, text = match().groups()
-        elif self.list_type is O_LIST:
-            number, marker, text = match().groups()
+            kind = UNORDERED_LINE
+        else:
+            kind = ORDERED_LINE
+        if not tags.kinds & kind:
+            return END
+        marker = tags.matches[kind].group('marker')
         if marker == self.marker:
             return CHILD
         if self.reset:
@@ -698,42 +808,22 @@ class List(Node):
             raise BadFormat('attempt to change list marker inside a list at line %d' % self.stream.line_no)
 
     @classmethod
-    def is_type(cls, last_line, line, next_line):
-        if match(UL, line):
-            marker, text = match().groups()
+    def is_type(cls, last_line, line, next_line, tags):
+        if tags.kinds & UNORDERED_LINE:
+            marker = tags.matches[UNORDERED_LINE].group('marker')
             return True, 0, {'marker': marker, 'list_type': U_LIST}
-        elif match(OL, line):
-            number, marker, text = match().groups()
+        elif tags.kinds & ORDERED_LINE:
+            marker = tags.matches[ORDERED_LINE].group('marker')
             return True, 0, {'marker': marker, 'list_type': O_LIST}
         return NO_MATCH
 
     def premature_end(self, line):
         pass
 
-    def to_html(self, indent=0):
-        spacing = ' ' * indent
-        if self.regex == UL:
-            start = spacing + '<ul>'
-            end = spacing + '</ul>'
-        else:
-            start = spacing + '<ol>'
-            end = spacing + '</ol>'
-        result = [start]
-        for item in self.items:
-            result.append(spacing + item.to_html())
-        result.append(end)
-        return '\n'.join(result)
-
 class ListItem(Node):
+    __slots__ = 'marker', 'list_type', 'regex'
     type = LISTITEM
-    allowed_blocks = CodeBlock, Image, List
     allowed_text = ALL_TEXT
-    regex = None
-    marker = None
-    number = None
-    blank_line_required = False
-    blank_line = RESET
-    terminate_after_children = False
 
     def __init__(self, marker=None, list_type=None, text=None, **kwds):
         super(ListItem, self).__init__(**kwds)
@@ -745,126 +835,129 @@ class ListItem(Node):
         else:
             self.regex = OL
 
-    def check(self, line):
-        # if blank line seen, make sure List knows about it
+    def parsing(self):
+        # the item's lines are read through a view of the list's stream, not by a
+        # read_lines() of its own -- see ItemStream
         self.parent.reset = True
-        if not self.items:
-            self.items.append(self.text)
-            self.text = None
-            return SAME
-        c_indent = len(self.marker) + 1
-        indent, text = match(CL, line).groups()
-        if not indent or len(indent) < c_indent:
-            return END
-        text = line[c_indent:]  # preserve beginning whitespace of sub-items
-        if self.reset:
-            # get empty line back
-            self.items.append('')
-        self.items.append(text)
-        return SAME
+        self.reset = False
+        self.text = None
+        lines = ItemStream(self.stream, self.indent + len(self.marker) + 1)
+        blocks = []
+        yield self.parse_run(blocks, lines)
+        self.items = blocks
+        self.end = lines.end
+        for block in blocks:
+            if block.end is not None and (self.end is None or block.end > self.end):
+                self.end = block.end
 
     @classmethod
-    def is_type(cls, last_line, line, next_line):
-        if match(UL, line):
-            marker, text = match().groups()
+    def is_type(cls, last_line, line, next_line, tags):
+        if tags.kinds & UNORDERED_LINE:
+            marker, text = tags.matches[UNORDERED_LINE].group('marker', 'text')
             return True, 0, {'marker': marker, 'list_type': U_LIST, 'text': text}
-        elif match(OL, line):
-            number, marker, text = match().groups()
+        elif tags.kinds & ORDERED_LINE:
+            number, marker, text = tags.matches[ORDERED_LINE].groups()
             return True, 0, {'marker': '%s%s'%(number,marker), 'list_type': O_LIST, 'text': text}
         return NO_MATCH
 
     def finalize(self):
         # remove paragraph status from item[0] if present
-        # handle sub-elements
-        final_items = []
-        sub_doc = Document('\n'.join(self.items), links=self.links)
-        final_items.extend(sub_doc.nodes)
-        self.items = final_items
         if self.items and isinstance(self.items[0], Paragraph):
-            self.items[0:1] = self.items[0].items
+            self.items[0:1] = texts = self.items[0].items
+            for text in texts:
+                text.parent = self
         return super(ListItem, self).finalize()
 
-    def to_html(self, indent=0):
-        spacing = ' ' * indent
-        start = '%s<li>' % spacing
-        end =  '%s</li>' % spacing
-        result = []
-        list_item = []
-        for i in self.items:
-            if not isinstance(i, List):
-                list_item.append(spacing+i.to_html())
-            else:
-                result.append('\n%s%s' % (spacing, i.to_html(indent+4)))
-        result.insert(0, start + ''.join(list_item) + end)
-        return ''.join(result)
-
 List.allowed_blocks = ListItem,
 
 class Rule(Node):
+    __slots__ = ()
     type = RULE
     allowed_text = None
 
-    def check(self, line):
+    def check(self, line, tags):
         self.items.append(line)
         return CONCLUDE
 
+    def finalize(self):
+        # the line itself is not needed
+        self.items = []
+        return super(Rule, self).finalize()
+
     @classmethod
-    def is_type(cls, last_line, line, next_line):
-        chars = set(line)
-        if len(line) >= 3 and len(chars) == 1 and chars.pop() in '-*':
+    def is_type(cls, last_line, line, next_line, tags):
+        if tags.kinds & RULE_LINE:
             return True, 0, {}
         return NO_MATCH
 
-    def to_html(self):
-        return '<hr>'
-
 
 class Text(Node):
+    __slots__ = 'style_bits',
     type = TEXT
     allowed_text = ALL_TEXT
 
-    def __init__(self, text=None, single='!', style=PLAIN, **kwds):
+    def __init__(self, text=None, style=PLAIN, **kwds):
         if 'stream' not in kwds:
             kwds['stream'] = None
-        self.text = text
-        self.char = single
-        self.style = style
         super(Text, self).__init__(**kwds)
+        self.text = text
+        if text is not None:
+            # plain text has no items, and needs no list to hold them
+            self.items = ()
+        # kept as a plain int; `style` presents it as a TextType
+        self.style_bits = int(style)
+
+    @property
+    def style(self):
+        return TextType(self.style_bits)
+
+    @style.setter
+    def style(self, style):
+        self.style_bits = int(style)
 
     def __repr__(self):
-        if self.text is None and not self.items:
-            return self.char
-        elif self.text:
+        if self.text is not None:
             return "%s(%s: %s)" % (self.__class__.__name__, self.style.name, self.text)
         else:
             return ("%s(style=%s,\n     items=%r)"
                     % (self.__class__.__name__, self.style, self.items))
 
-    def to_html(self):
-        start = ''
-        end = ''
-        for mark in (BOLD, ITALIC, CODE, MONO, STRIKE, UNDERLINE, HIGHLIGHT, SUB, SUPER, FOOT_NOTE):
-            if mark in self.style:
-                start = start + mark.start
-                end = mark.end + end
-        if self.text is not None:
-            body = escape(self.text)
+    def copy(self, parent=None):
+        """
+        return a copy of this node, and of its items, belonging to parent -- or
+        to nothing, for keeping
+        """
+        # the items are copied with a stack, not by recursing, as they can be
+        # nested as deep as max_inline_depth allows
+        copies = []
+        todo = [(self, parent, copies)]
+        while todo:
+            node, parent, items = todo.pop()
+            new = node._copy(parent)
+            items.append(new)
+            if node.text is None:
+                new.items = []
+                todo.extend((item, new, new.items) for item in reversed(node.items))
+        return copies[0]
+
+    def _copy(self, parent):
+        # a copy of this node alone; its items are left to copy()
+        new = self.__class__.__new__(self.__class__)
+        for name in slot_names(self.__class__):
+            setattr(new, name, getattr(self, name))
+        new.parent = parent
+        new.context = parent is not None and parent.context or None
+        if new.context is None:
+            new.node_id = None
+            new.links = {}
         else:
-            result = []
-            for txt in self.items:
-                try:
-                    result.append(txt.to_html())
-                except AttributeError:
-                    print('v' * 50)
-                    print(self)
-                    print('^' * 50)
-                    raise
-            body = ''.join(result)
-        return '%s%s%s' % (start, body, end)
+            new.node_id = new.context.next_id()
+            new.links = parent.links
+        return new
 
 
 class IDLink(Node):
-    type = LINK
+    __slots__ = 'type', 'nested', 'marker'
     allowed_blocks = CodeBlock, List, Image, Paragraph
     allowed_text = ALL_TEXT
     blank_line = INCLUDE
@@ -877,29 +970,28 @@ class IDLink(Node):
         else:
             #external link
             self.type = 'link'
+        # a foot note's text can hold blocks
+        self.nested = self.type == 'footnote'
         self.marker = marker
         self.text = text
 
-    def check(self, line):
-        if not self.items:
+    def check(self, line, tags):
+        if self.text is not None:
             self.indent += len(self.marker) + 4
             self.items.append(self.text)
             self.text = None
             return SAME
-        if match(ID_LINK, line):
+        if tags.kinds & ID_LINK_LINE:
             return END
         self.items.append(line)
         return SAME
 
     def finalize(self):
         if self.type == 'footnote':
-            final_items = []
-            sub_doc = Document('\n'.join(self.items), links=self.links)
-            final_items.extend(sub_doc.nodes)
-            # self.items = format(final_items, allowed_styles=self.allowed_text, parent=self)
-            self.items = final_items
             if self.items and isinstance(self.items[0], Paragraph):
-                self.items[0:1] = self.items[0].items
+                self.items[0:1] = texts = self.items[0].items
+                for text in texts:
+                    text.parent = self
             for link in self.links[self.marker]:
                 link.final = True
             keep = True
@@ -913,39 +1005,27 @@ class IDLink(Node):
                     raise Exception('unknown link type %r [%r]' % (type(link), self.text))
                 link.final = True
             keep = False
+        self.release()
         return keep
 
     @classmethod
-    def is_type(cls, last_line, line, next_line):
-        if match(ID_LINK, line):
-            marker, text = match().groups()
+    def is_type(cls, last_line, line, next_line, tags):
+        if tags.kinds & ID_LINK_LINE:
+            marker, text = tags.matches[ID_LINK_LINE].groups()
             return True, 0, {'marker': marker, 'text': text}
         return NO_MATCH
 
     def premature_end(self, line):
-        if match(ID_LINK, line):
+        if self.stream.tags().kinds & ID_LINK_LINE:
             # if ending non-blank line is another footnote, we're okay
             pass
         else:
             super(IDLink, self).premature_end(line)
 
-    def to_html(self):
-        s_marker = self.marker[1:]
-        start = '<div class="footnote" id="footnote-%s"><sup>%s</sup>' % (s_marker, s_marker)
-        end = '</div>'
-        result = []
-        for item in self.items:
-            if self.type == 'footnote' and not isinstance(item, Text):
-                result.append('\n')
-            result.append(item.to_html())
-        if result[-1][-1] == '\n':
-            result[-1][-1] = ''
-        return "%s%s%s" % (start, ''.join(result), end)
-
 
 class Link(Text):
     # Wiki, external, and footnote
-    type = LINK
+    __slots__ = 'type', 'marker', 'url'
     allowed_text = PLAIN
 
     def __init__(self, text=None, url=None, marker=None, **kwds):
@@ -955,6 +1035,8 @@ class Link(Text):
         marker: identifier for footnotes and separate external links
         """
         super(Link, self).__init__(**kwds)
+        self.items = ()
+        self.type = LINK
         self.marker = marker = marker and marker.strip()
         self.url = url = url and url.strip()
         text = text and text.strip()
@@ -963,11 +1045,9 @@ class Link(Text):
                 s_marker = escape(marker[1:])
                 self.type = 'footnote'
                 self.text = '<sup><a href="#footnote-%s">%s</a></sup>' % (s_marker, s_marker)
-                self.links.setdefault(marker, []).append(self)
             else:
                 self.type = 'separate'
                 self.text = '<a href="%%s">%s</a>' % (escape(text), )
-                self.links.setdefault(marker, []).append(self)
         elif text == url:
             # either a wiki page link, or the real link will be discovered later
             self.type = 'self'
@@ -975,13 +1055,29 @@ class Link(Text):
             self.marker = url
             self.text = '<a href="%%s">%s</a>' % stext
             self.url = '<a href="%s">%s</a>' % (url, stext)
-            self.links.setdefault(url, []).append(self)
         elif url is not None:
             self.type = 'simple'
             self.text = '<a href="%s">%s</a>' % (url, escape(text))
             self.final = True
+        self.register()
+
+    def _copy(self, parent):
+        new = super(Link, self)._copy(parent)
+        if new.context is not None:
+            new.register()
+        return new
 
-    def to_html(self):
+    def register(self):
+        """
+        add self to the links waiting for their marker to be resolved
+        """
+        if not self.final:
+            self.links.setdefault(self.marker, []).append(self)
+
+    def resolve(self):
+        """
+        return the link's html, now that its marker should have been found
+        """
         if not self.final:
             if self.url is None:
                 raise MissingLink('link %r never found' % (self.marker, ))
@@ -990,10 +1086,12 @@ class Link(Text):
         return self.text
 
 class BlockQuote(Node):
+    __slots__ = 'level',
     type = QUOTE
     allowed_text = ALL_TEXT
     terminate_after_children = False
     blank_line_required = False
+    nested = True
 
     def __init__(self, **kwds):
         super(BlockQuote,self).__init__(**kwds)
@@ -1001,9 +1099,9 @@ class BlockQuote(Node):
         if isinstance(self.parent, self.__class__):
             self.level += self.parent.level
 
-    def check(self, line):
-        if match(BQ, line):
-            level = len(match.groups()[0])
+    def check(self, line, tags):
+        if tags.kinds & QUOTE_LINE:
+            level = len(tags.matches[QUOTE_LINE].group(1))
             line = line[level:]
             if line and line[0] != ' ':
                 raise BadFormat('a space is needed in %r' % line)
@@ -1019,80 +1117,50 @@ class BlockQuote(Node):
 
 
     @classmethod
-    def is_type(cls, last_line, line, next_line):
-        if match(BQ, line):
+    def is_type(cls, last_line, line, next_line, tags):
+        if tags.kinds & QUOTE_LINE:
             return True, 0, {}
         return NO_MATCH
-
-    def finalize(self):
-        # handle sub-elements
-        final_items = []
-        doc = []
-        for item in self.items:
-            if isinstance(item, unicode):
-                # simple text, append it
-                doc.append(item)
-            else:
-                # an embedded node, process any text lines
-                if doc:
-                    doc = Document('\n'.join(doc), links=self.links)
-                    final_items.extend(doc.nodes)
-                doc = []
-                final_items.append(item)
-        if doc:
-            doc = Document('\n'.join(doc), links=self.links)
-            final_items.extend(doc.nodes)
-        # self.items = format(final_items, allowed_styles=self.allowed_text, parent=self)
-        self.items = final_items
-        return super(BlockQuote, self).finalize()
-
-    def to_html(self):
-        mid_space = '\n' + ' ' * 12
-        start = '<blockquote>'
-        end = '\n</blockquote>'
-        result = []
-        result.append(start)
-        for item in self.items:
-            if isinstance(item, Node):
-                result.append(mid_space + mid_space.join(item.to_html().split('\n')))
-            else:
-                result.append(mid_space + item)
-        result.append(end)
-        return ''.join(result)
 BlockQuote.allowed_blocks = (BlockQuote, )
 
 class Detail(Node):
+    __slots__ = 'summary', 'body'
     type = DETAIL
     allowed_text = ALL_TEXT
     terminate_after_children = False
     blank_line_required = True
+    nested = True
 
     def __init__(self, summary, text, **kwds):
         super(Detail,self).__init__(**kwds)
         self.text = text
         self.summary = summary
+        # whether any detail lines have been read
+        self.body = False
         if isinstance(self.parent, self.__class__):
             raise BadFormat('nested details not supported (%r)' % self.stream.line_no)
 
-    def check(self, line):
+    def check(self, line, tags):
         if self.text is not None:
             self.items.append(self.text)
             self.text = None
+            self.body = True
             return SAME
-        if match(DTLS, line):
-            if self.items:
+        if tags.kinds & SUMMARY_LINE:
+            if self.body:
                 raise BadFormat('blank line required to separate detail blocks (%r)' % line)
             return SAME
-        if match(DTLD, line):
-            marker, text = match.groups()
+        if tags.kinds & DETAIL_LINE:
+            marker, text = tags.matches[DETAIL_LINE].groups()
             self.items.append(text)
+            self.body = True
             return SAME
         return END
 
     @classmethod
-    def is_type(cls, last_line, line, next_line):
-        if match(DTLS, line) or match(DTLD, line):
-            marker, text = match().groups()
+    def is_type(cls, last_line, line, next_line, tags):
+        if tags.kinds & (SUMMARY_LINE | DETAIL_LINE):
+            marker, text = tags.matches[tags.kinds & (SUMMARY_LINE | DETAIL_LINE)].groups()
             summary = None
             if marker == '-->':
                 summary = text
@@ -1104,53 +1172,27 @@ class Detail(Node):
         # handle summary
         if self.summary:
             self.summary = format(self.summary, allowed_styles=self.allowed_text, parent=self)
-        # handle sub-elements
-        # final_items = []
-        doc = Document('\n'.join(self.items), links=self.links)
-        # self.items = format(doc.nodes, allowed_styles=self.allowed_text, parent=self)
-        self.items = doc.nodes
         return super(Detail, self).finalize()
 
-    def to_html(self):
-        start = '\n<details>'
-        end = '</details>'
-        result = []
-        result.append(start)
-        if self.summary:
-            sums = []
-            for item in self.summary:
-                if isinstance(item, Node):
-                    sums.append(item.to_html())
-                else:
-                    sums.append(item)
-            result.append('<summary>%s</summary>' % ''.join(sums))
-        for item in self.items:
-            if isinstance(item, Node):
-                result.append(item.to_html())
-            else:
-                result.append(item)
-        result.append(end)
-        return '\n'.join(result)
-
 class Table(Node):
+    __slots__ = (
+            'initial', 'cell_count', 'rows', 'header_rows', 'body_rows', 'footer_rows',
+            'html_attrs', 'caption',
+            )
     type = TABLE
     allowed_text = ALL_TEXT
     blank_line_required = True
-    cell_count = 0
-    header_rows = []
-    body_rows = []
-    footer_rows = []
-    rows = []
-    dividers = 0
-    html_attrs = ''
-    caption = None
 
     def __init__(self, line, **kwds):
         super(Table, self).__init__(**kwds)
         self.initial = True
+        self.cell_count = 0
         self.header_rows = []
         self.body_rows = []
+        self.footer_rows = []
         self.rows = []
+        self.html_attrs = ''
+        self.caption = None
         # check for caption
         if line.startswith('|[') and ']|' in line:
             # treat it as a caption
@@ -1174,7 +1216,7 @@ class Table(Node):
             cells = self.split_row(line)
             self.cell_count = len(cells)
 
-    def check(self, line):
+    def check(self, line, tags):
         initial, self.initial = self.initial, False
         if initial and self.caption is not None:
             return SAME
@@ -1253,48 +1295,16 @@ class Table(Node):
                     cell.text = format(cell.text, allowed_styles=self.allowed_text, parent=self)
         if self.caption:
             self.caption = format(self.caption, allowed_styles=self.allowed_text, parent=self)
+        # the cells are all in header_rows, body_rows, and footer_rows now
+        self.rows = None
         return super(Table, self).finalize()
 
     @classmethod
-    def is_type(cls, last_line, line, next_line):
-        if line.startswith('|'):
+    def is_type(cls, last_line, line, next_line, tags):
+        if tags.kinds & TABLE_LINE:
             return True, 0, {'line':line}
         return NO_MATCH
 
-    def to_html(self):
-        result = ['<div%s><table>' % self.html_attrs]
-        if self.caption:
-            result.append('    <caption>%s</caption>' % ''.join(t.to_html() for t in self.caption))
-        if self.header_rows:
-            result.append('    <thead>')
-            for row in self.header_rows:
-                result.append('        <tr>')
-                for cell in row:
-                    result.append('            %s' % cell.to_html())
-                # result.append('            <th>%s</th>' % ''.join([c.to_html() for c in cell]))
-                result.append('        </tr>')
-            result.append('    </thead>')
-        if self.body_rows:
-            result.append('    <tbody>')
-            for row in self.body_rows:
-                result.append('        <tr>')
-                for cell in row:
-                    result.append('            %s' % cell.to_html())
-                    # result.append('            <td>%s</td>' % ''.join([c.to_html() for c in cell]))
-                result.append('        </tr>')
-            result.append('    </tbody>')
-        if self.footer_rows:
-            result.append('    <tfoot>')
-            for row in self.footer_rows:
-                result.append('        <tr>')
-                for cell in row:
-                    result.append('            %s' % cell.to_html())
-                    # result.append('            <td>%s</td>' % ''.join([c.to_html() for c in cell]))
-                result.append('        </tr>')
-            result.append('    </tfoot>')
-        result.append('</table></div>')
-        return '\n'.join(result)
-
     def split_row(self, line):
         if line[0] != '|' or (line[-1] != '|' and line[-2:] != '\\/') or line[-1] == '\\':
             raise BadFormat('table lines must start with | and end with | or \\/ [%r]' % line)
@@ -1339,6 +1349,8 @@ class Table(Node):
 
 class Cell(object):
 
+    __slots__ = 'text', 'colspan', 'rowspan', 'type'
+
     def __init__(self, text, type='body'):
         self.text = text
         self.colspan = None
@@ -1350,32 +1362,19 @@ class Cell(object):
         rowspan = '' if not self.rowspan else ', rowspan="%s"' % self.rowspan
         return "Cell(%r%s%s)" % (self.text, colspan, rowspan)
 
-    def to_html(self):
-        if self.type == 'header':
-            open_tag = '<th'
-            close_tag = '</th>'
-        else:
-            open_tag = '<td'
-            close_tag = '</td>'
-        classes = []
-        if self.rowspan:
-            open_tag += ' rowspan="%s"' % self.rowspan
-            classes.append('merged_rows')
-        if self.colspan:
-            open_tag += ' colspan="%s"' % self.colspan
-            classes.append('merged_cols')
-        if classes:
-            open_tag += ' class="%s"' % ' '.join(classes)
-        open_tag += '>'
-        content = ''.join(t.to_html() for t in self.text)
-        return "%s%s%s" % (open_tag, content, close_tag)
+    def to_html(self, compact=False):
+        html = []
+        HtmlRenderer(html.append, compact).render(self)
+        return ''.join(html)
 
 
 class ID(Node):
+    __slots__ = ()
     type = ID
     allowed_text = None
 
 class Definition(Node):
+    __slots__ = ()
     type = DEFINITION
     allowed_text = ALL_TEXT
 
@@ -1389,39 +1388,58 @@ class PPLCStream(object):
     # current_line
     line_no = 0
 
-    # current_line is the line pointed to by line_no, and the line that *_char functions deal with
-    @property
-    def current_line(self):
-        return ''.join(self.chars)
+    # current_line is the line pointed to by line_no, with its new-line, or an empty string once
+    # the lines are used up
+    current_line = ''
+
+    # offset is where current_line starts in the source
+    offset = 0
 
-    def __init__(self, text):
-        self.data = text.split('\n')
-        self.data.reverse()
-        self.chars = []
+    # LineTags for current_line, made when first asked for
+    _tags = None
+
+    def __init__(self, source):
+        """
+        source: the text, a file opened in text mode, or any iterable of lines;
+                lines are pulled as needed, one ahead of current_line
+        """
+        self.data = split_lines(source)
         self.line_no = 0
-        if self.data:
-            self.chars = list(self.data.pop()) + ['\n']
+        self.offset = 0
+        self.current_line = self._line()
+        self.next_line = self._line()
         self.last_line = ''
 
     def __bool__(self):
         return bool(self.current_line)
     __nonzero__ = __bool__
 
+    def _line(self):
+        line = next(self.data, None)
+        if line is None:
+            return ''
+        return line + '\n'
+
     def _get_line(self):
-        if not self.chars:
+        if not self.current_line:
             raise EOFError
-        line = ''.join(self.chars)
-        self.chars = []
+        line = self.current_line
         self.line_no += 1
-        if self.data:
-            self.chars = list(self.data.pop()) + ['\n']
+        self.offset += len(line)
+        self._tags = None
+        self.current_line = self.next_line
+        self.next_line = self._line()
         return line
 
     def peek_line(self):
         "return line after current line, or an empty string"
-        if self.data:
-            return self.data[-1] + '\n'
-        return ''
+        return self.next_line
+
+    def tags(self, offset=0):
+        "return the LineTags for current line, less its first offset characters"
+        if self._tags is None:
+            self._tags = LineTags(self.current_line.rstrip())
+        return self._tags.at(offset)
 
     def skip_blank_lines(self):
         while self:
@@ -1435,361 +1453,878 @@ class PPLCStream(object):
             self.last_line = self.current_line
             self._get_line()
 
-def format(texts, allowed_styles, parent, _recurse=False):
-    def f(open, close, start=0, ws_needed=True):
-        end = len(chars)
-        match_len = len(close or open)
-        open_count = 1
-        close_count = 0
-        i = start
-        while i < end:
-            if chars[i].char == '\\':
-                if _recurse:
-                    i += 2
-                else:
-                    del chars[i]
-                    i += 1
-                continue
-            possible = ''.join(c.char for c in chars[i:i+match_len])
-            if possible == close:
-                # count must be the same
-                # whitespace setting must match
-                if not ws_needed:
-                    if open == close:
-                        # count doesn't matter
-                        # whitespace doesn't matter
-                        return i
-                    close_count += 1
-                    if open_count == close_count:
-                        return i
-                else:
-                    # check for needed whitespace
-                    if ws(i+1):
-                        close_count += 1
-                        if open_count == close_count:
-                            return i
-            # check for valid open tag
-            if possible == open:
-                if not ws_needed or ws(i, forward=False):
-                    open_count += 1
-                    i += match_len - 1
-            i += 1
+class SubStream(PPLCStream):
+    """
+    view of the lines of a block nested in another stream, such as a list item's
+
+    lines yields (line, tags, offset) triples, with the line's indentation or prefix
+    already removed, its LineTags if known, and where it starts in the original
+    source; they are read from the parent stream only as needed, and are not copied
+    into a new text to be split and classified again
+    """
+
+    # LineTags for next_line, if known
+    _next_tags = None
+
+    # where next_line starts in the source
+    _next_offset = 0
+
+    def __init__(self, lines):
+        self.data = iter(lines)
+        self.line_no = 0
+        self.current_line = self._line()
+        self._tags = self._next_tags
+        self.offset = self._next_offset
+        self.next_line = self._line()
+        self.last_line = ''
+
+    def _line(self):
+        line, self._next_tags, self._next_offset = next(self.data, (None, None, None))
+        if line is None:
+            return ''
+        return line + '\n'
+
+    def _get_line(self):
+        tags = self._next_tags
+        offset = self._next_offset
+        line = super(SubStream, self)._get_line()
+        self._tags = tags
+        self.offset = offset
+        return line
+
+class ItemStream(PPLCStream):
+    """
+    view of the lines of a list item: its first line after the marker, then the
+    lines indented past the marker, less that indentation, with any run of blank
+    lines cut to one
+
+    it keeps no position of its own, it moves the stream it is over; the view of an
+    item in an item is over the same stream, indented further, so a line costs the
+    same however deep the lists are nested
+    """
+
+    def __init__(self, stream, indent):
+        if isinstance(stream, ItemStream):
+            indent += stream.indent
+            stream = stream.stream
+        self.stream = stream
+        self.indent = indent
+        self.margin = ' ' * indent
+        # the line with the item's marker; the stream may be moved past it by an
+        # item that starts on it too
+        self._first_no = stream.line_no
+        # the line last skipped here, while the stream is still just past it
+        self._last = ''
+        self._last_no = stream.line_no
+        # the current line as seen here, and the stream line it was made from
+        self._line = None
+        self._line_no = None
+        # where the last line with any text ends in the source
+        self.end = None
+
+    def view(self, line, first=False):
+        "return line as seen here: less the indent, '\\n' if blank, or '' if not in the item"
+        text = line.rstrip()
+        if first:
+            return text[self.indent:] + '\n'
+        if not text:
+            return line and '\n'
+        if text.startswith(self.margin):
+            return text[self.indent:] + '\n'
+        return ''
+
+    @property
+    def current_line(self):
+        stream = self.stream
+        if self._line_no != stream.line_no:
+            self._line = self.view(stream.current_line, stream.line_no == self._first_no)
+            self._line_no = stream.line_no
+        return self._line
+
+    @property
+    def next_line(self):
+        return self.view(self.stream.next_line)
+
+    @property
+    def last_line(self):
+        if self._last_no == self.stream.line_no:
+            return self._last
+        # an item nested in this one moved the stream
+        return self.view(self.stream.last_line)
+
+    @property
+    def line_no(self):
+        return self.stream.line_no
+
+    @property
+    def offset(self):
+        return self.stream.offset + self.indent
+
+    def tags(self, offset=0):
+        "return the LineTags for current line, less its first offset characters"
+        return self.stream.tags(self.indent + offset)
+
+    def skip_line(self, count=1):
+        stream = self.stream
+        for _ in range(count):
+            line = self.current_line
+            if not line:
+                raise EOFError
+            if line.strip():
+                self.end = stream.offset + len(stream.current_line.rstrip())
+                stream.skip_line()
+            else:
+                stream.skip_line()
+                while stream and not stream.current_line.strip():
+                    stream.skip_line()
+            self._last = line
+            self._last_no = stream.line_no
+
+class LineTags(object):
+    """
+    the kinds of block a (right-stripped) line could start or continue, worked
+    out in one pass: the first character after any leading spaces picks the
+    few patterns worth trying
+
+    kinds is a mask of the *_LINE values, and matches holds the regex match,
+    made without the leading spaces, for each kind that has details
+    """
+
+    __slots__ = 'line', 'spaces', 'kinds', 'matches', 'content_kinds', 'title', 'shifted'
+
+    def __init__(self, line):
+        content = line.lstrip(' ')
+        self.line = line
+        self.spaces = len(line) - len(content)
+        self.matches = matches = {}
+        self.shifted = {}
+        kinds = 0
+        if not content:
+            kinds = BLANK_LINE
         else:
-            return -1
-    def s(start=None, ws=False, forward=True):
-        if start is None:
-            start = pos
-        if forward:
-            for ch in chars[start:]:
-                if not ch.char.isalnum() and ch.char.strip():
+            first = content[0]
+            if first.strip():
+                kinds = TEXT_LINE
+            starts = LINE_STARTS.get(first)
+            if starts is None and first.isdigit():
+                starts = LINE_STARTS['0']
+            for kind, regex in starts or ():
+                if regex is None:
+                    kinds |= kind
                     continue
-                if ws and not ch.char.strip():
-                    return True
-                if not ws and ch.char.strip():
-                    return True
-                return False
-            return ws
+                found = regex.match(content)
+                if found is not None:
+                    kinds |= kind
+                    matches[kind] = found
+        self.content_kinds = kinds
+        # a first level heading marker can have any leading whitespace
+        chars = set(line.strip())
+        self.title = len(chars) == 1 and '=' in chars
+        self.kinds = self.kinds_at(self.spaces, len(line))
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.line)
+
+    def kinds_at(self, spaces, length):
+        "kinds of the line when it has `spaces` leading spaces and is `length` long"
+        if not spaces:
+            kinds = self.content_kinds
         else:
-            if start == 0:
-                return ws
-            for ch in chars[start-1::-1]:
-                if not ch.char.isalnum() and ch.char.strip():
-                    continue
-                if ws and not ch.char.strip():
-                    return True
-                if not ws and ch.char.strip():
-                    return True
-                return False
-            return ws
-    ws = lambda start, forward=True: s(start, ws=True, forward=forward)
-    non_ws = lambda start, forward=True: s(start, ws=False, forward=forward)
-    find = Var(f)
-    peek_char = Var(lambda index, len=1: ''.join(c.char for c in chars[index:index+len]))
+            # only code blocks can be indented
+            kinds = self.content_kinds & FENCE_LINE
+            if spaces >= 4:
+                kinds |= CODE_LINE
+        if self.title and length >= 3:
+            kinds |= TITLE_LINE
+        return kinds
+
+    def at(self, offset):
+        """
+        return the LineTags for line[offset:]
+        """
+        if not offset:
+            return self
+        tags = self.shifted.get(offset)
+        if tags is None:
+            if offset > self.spaces:
+                # not just spaces being removed, so look again
+                tags = self.__class__(self.line[offset:])
+            else:
+                tags = self.__class__.__new__(self.__class__)
+                tags.line = self.line[offset:]
+                tags.spaces = self.spaces - offset
+                tags.matches = self.matches
+                tags.content_kinds = self.content_kinds
+                tags.title = self.title
+                tags.shifted = {}
+                tags.kinds = self.kinds_at(tags.spaces, len(tags.line))
+            self.shifted[offset] = tags
+        return tags
+
+
+def split_lines(source):
+    """
+    yield the lines of source without their new-lines, reading a file or other
+    iterable of lines only as far as needed
 
-    if isinstance(texts, basestring):
-        texts = [texts]
-    result = []
-    if _recurse:
-        chars = texts
+    like str.split('\n'), text that ends with a new-line has a final empty line
+    """
+    if isinstance(source, basestring):
+        start = 0
+        stop = source.find('\n')
+        while stop != -1:
+            yield source[start:stop]
+            start = stop + 1
+            stop = source.find('\n', start)
+        yield source[start:]
     else:
-        chars = []
-        # convert to 'c' format
-        for text in texts:
-            if isinstance(text, Node):
-                # already processed
-                chars.append(text)
+        ended = True
+        for line in source:
+            ended = line.endswith('\n')
+            if ended:
+                line = line[:-1]
+            yield line
+        if ended:
+            yield ''
+
+def run_parsing(steps, node=None):
+    """
+    run steps, the parsing() of node or of a Document, and return whether to keep
+    node (its finalize() result)
+
+    each node steps yields is parsed in turn, its own parsing() run and then
+    finalize(), and whether to keep it sent back; a generator it yields is run in
+    its place -- the work is kept on a stack, so nodes can be nested as deep as the
+    text goes, without running into the recursion limit
+    """
+    stack = [(node, steps)]
+    sent = None
+    while stack:
+        node, steps = stack[-1]
+        try:
+            step = steps.send(sent)
+        except StopIteration:
+            stack.pop()
+            sent = None
+            if node is not None:
+                sent = node.finalize()
+            continue
+        sent = None
+        if isinstance(step, Node):
+            stack.append((step, step.parsing()))
+        else:
+            stack.append((None, step))
+    return sent
+
+class FormatCache(object):
+    """
+    bounded LRU cache of format() results, which can be shared by any number of
+    Documents (in any number of threads) via their `format_cache` argument
+
+    results are stored as copies, and every hit returns fresh copies belonging
+    to the asking node, so links are registered in that node's document
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.results)
+
+    def __repr__(self):
+        return ("%s(size=%r, hits=%r, misses=%r, current=%r)"
+                % (self.__class__.__name__, self.size, self.hits, self.misses, len(self.results)))
+
+    def clear(self):
+        with self.lock:
+            self.hits = self.misses = 0
+            self.results.clear()
+
+    def get(self, key, parent):
+        """
+        return copies of the cached result for key, or None
+        """
+        with self.lock:
+            result = self.results.pop(key, None)
+            if result is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # most recently used goes to the end
+            self.results[key] = result
+        return [node.copy(parent) for node in result]
+
+    def put(self, key, result):
+        """
+        save copies of result, discarding the least recently used if full
+        """
+        if self.size <= 0:
+            return
+        result = [node.copy() for node in result]
+        with self.lock:
+            self.results[key] = result
+            while len(self.results) > self.size:
+                self.results.popitem(last=False)
+
+
+def mark_line(node, line, gap):
+    """
+    record where line, about to be added to node's items, starts in the joined
+    text (gap characters after the end of the line before) and in the source
+    """
+    marks = node.marks
+    pos = 0
+    if marks:
+        last, source, length = marks[-1]
+        pos = last + length + gap
+    marks.append((pos, node.stream.offset + node.indent, len(line)))
+
+def format(texts, allowed_styles, parent, marks=None):
+    """
+    convert texts into a list of Text and Link nodes
+
+    every node made gets the span of source it came from: marks, from
+    mark_line(), map offsets in the joined texts to offsets in the source;
+    without them each node gets its parent's span
+
+    the text is walked once, left to right, to decide what everything is:
+    code, mono, links, and footnotes are resolved as soon as they are seen
+    (their closers having been found by find_pairs()), while emphasis markers
+    are kept on a delimiter stack until a valid closing marker shows up;
+    parentheticals and editorial comments each get their own stack, since
+    emphasis cannot cross their borders
+
+    each decision is recorded as an event at its offset, and the events are
+    then replayed in order to build the nodes -- everything between two events
+    is plain text, and output is only ever appended to the innermost open Text
+
+    nesting is tracked with explicit stacks, not recursion; markup nested more
+    than the context's max_inline_depth deep is a BadFormat
+    """
+    def too_deep(pos):
+        return BadFormat(
+                'markup nested more than %d deep near %r between %r and %r'
+                % (context.max_inline_depth, text[max(0, pos-10):pos+10], parent.start_line, parent.end_line))
+    def collect(start, stop):
+        # raw text between start and stop, with escapes removed
+        raw = text[start:stop]
+        if '\\' in raw:
+            raw = ESCAPED.sub(r'\1', raw)
+        return raw
+    def punct_run(pos):
+        # the run of punctuation pos is in, and whether a word comes right before
+        # it; a code, mono or link span already resolved counts as punctuation, so
+        # a run that reaches back into one goes on before it
+        punct = runs[0]
+        while punct is None or punct.end() <= pos:
+            punct = PUNCT_RUN.search(text, punct and punct.end() or 0)
+        runs[0] = punct
+        start = punct.start()
+        if start < span[0] <= pos:
+            return punct, span[1]
+        return punct, start > floor and text[start-1].isalnum()
+    def closes(marker, word_before, word_after):
+        return word_before and (not MARKER_STYLES[marker].whitespace or not word_after)
+    def flush(items, start, stop):
+        # pending plain text becomes a Text node
+        if string:
+            plain = ''.join(string)
+            del string[:]
+            if plain:
+                txt = Text(plain, parent=parent)
+                txt.start, txt.end = start, stop
+                items.append(txt)
+    def place(result):
+        # offsets so far are into text; move them into the source
+        if marks:
+            positions = [m[0] for m in marks]
+        todo = list(result)
+        while todo:
+            node = todo.pop()
+            if id(node) in passed:
                 continue
+            if not marks:
+                node.start, node.end = parent.start, parent.end
             else:
-                chars.extend([Text(single=c, parent=parent) for c in text])
-    # look for subgroups: parentheticals, editorial comments, links, etc
-    # link types: internal, wiki, external, footnote
-    pos = end = 0
-    while pos < len(chars):
-        start = pos
-        ch = chars[pos]
-        if ch.final:
-            result.append(ch)
+                # a span that ends where a line starts ends on the line before
+                pos, source, length = marks[max(0, bisect_right(positions, node.start) - 1)]
+                node.start = source + node.start - pos
+                pos, source, length = marks[max(0, bisect_left(positions, node.end) - 1)]
+                node.end = source + node.end - pos
+            if node.text is None:
+                todo.extend(node.items)
+        return result
+
+    if isinstance(texts, basestring):
+        texts = [texts]
+    # nodes passed in are kept by offset, with a place-holder in the text
+    nodes = {}
+    pieces = []
+    length = 0
+    passed = set()
+    for piece in texts:
+        if isinstance(piece, Node):
+            # already processed
+            nodes[length] = piece
+            passed.add(id(piece))
+            piece = NODE
+        pieces.append(piece)
+        length += len(piece)
+    text = ''.join(pieces)
+    end = len(text)
+    # nothing else about the parent changes the result, so if there are no
+    # nodes to be included it can be shared through the cache
+    cache = key = None
+    context = parent.context
+    if context.format_cache is not None and not nodes:
+        cache = context.format_cache
+        key = text, allowed_styles, context.max_inline_depth
+        result = cache.get(key, parent)
+        if result is not None:
+            return place(result)
+    pairs = find_pairs(text, parent)
+    # an event is [offset, length, action, value]:
+    #   NODE_EVENT  - value is a node to add
+    #   TEXT_EVENT  - value is the text to use instead
+    #   NOTE_EVENT  - value is a foot note Link; spaces before it are dropped
+    #   OPEN_EVENT / CLOSE_EVENT - start or end of an emphasis span, value is the marker
+    # an emphasis delimiter is an event whose action stays None until it is
+    # matched; open delimiters are kept per marker in `openers`, and each
+    # parenthetical or editorial comment gets its own set
+    events = []
+    openers = {}
+    groups = []
+    # first character a boundary check may look at
+    floor = 0
+    # the run of punctuation the current emphasis marker is in; its neighbours
+    # decide whether the marker can open or close
+    runs = [None]
+    # where the last code, mono or link span ends, and whether a word comes
+    # before it
+    span = [-1, False]
+    pos = 0
+    while pos < end:
+        # plain text is left for the second pass
+        found = MARKUP.search(text, pos)
+        if found is None:
+            break
+        pos = found.start()
+        char = text[pos]
+        if char == NODE and pos in nodes:
+            events.append([pos, 1, NODE_EVENT, nodes[pos]])
             pos += 1
             continue
-        if ch.char == '\\':
-            if _recurse:
-                pos += 2
-            else:
-                del chars[pos]
-                pos += 1
+        if char == '\\':
+            # the next character is not markup
+            events.append([pos, 2, TEXT_EVENT, text[pos+1:pos+2]])
+            pos += 2
             continue
-        if ch.char == "`":
+        if char == '`':
             # code or pre
-            if ''.join(c.char for c in chars[pos:pos+2]) == '``':
-                # pre
-                end = find("``", "``", start+2, False)
-                if end == -1:
-                    # oops
-                    raise BadFormat( 'failed to find matching "``" starting near %r between %r and %r' % (chars[pos-10:pos+10], parent.start_line, parent.end_line))
-                chars[start:end+2] = [Text(
-                        ''.join([c.char for c in chars[start+2:end]]),
-                        style=MONO,
-                        parent=parent,
-                        )]
-                pos += 2
-                continue
+            if text.startswith('``', pos):
+                marker, style = '``', MONO
             else:
-                # code
-                end = find("`", "`", start+1, False)
-                if end == -1:
-                    # oops
-                    raise BadFormat( 'failed to find matching "`" starting near %r between %r and %r' % (chars[pos-10:pos+10], parent.start_line, parent.end_line))
-                chars[start:end+1] = [Text(
-                        ''.join([c.char for c in chars[start+1:end]]),
-                        style=CODE,
-                        parent=parent,
-                        )]
-                pos += 1
-                continue
-        if ch.char == "`":
-            # code
-            end = find("`", "`", start+1, False)
-            if end == -1:
-                # oops
-                raise BadFormat( 'failed to find matching "`" starting near %r between %r and %r' % (chars[pos-10:pos+10], parent.start_line, parent.end_line))
-            chars[start:end+1] = [Text(
-                    ''.join([c.char for c in chars[start+1:end]]),
-                    style=CODE,
-                    parent=parent,
-                    )]
-            pos += 1
+                marker, style = '`', CODE
+            stop = pairs[pos] + len(marker)
+            txt = Text(collect(pos+len(marker), stop-len(marker)), style=style, parent=parent)
+            txt.start, txt.end = pos, stop
+            span[:] = stop, punct_run(pos)[1]
+            events.append([pos, stop-pos, NODE_EVENT, txt])
+            pos = stop
             continue
-        if ch.char == '(':
-            # parens
-            end = find('(', ')', start+1, False)
-            if end == -1:
-                # oops
-                raise BadFormat(
-                        "failed to find matching `)` starting near %r between %r and %r"
-                        % (chars[pos-10:pos+10], parent.start_line, parent.end_line))
-            chars[start+1:end] = format(chars[start+1:end], allowed_styles, parent=parent, _recurse=True)
-            pos += 3
+        if char == '(' or text.startswith('[[', pos):
+            # parenthetical or editorial comment
+            if len(groups) == context.max_inline_depth:
+                raise too_deep(pos)
+            groups.append((pairs[pos], openers, floor))
+            if char == '[':
+                events.append([pos, 2, TEXT_EVENT, char])
+            pos += 1 + (char == '[')
+            openers = {}
+            floor = pos
             continue
-        if ch.char == '[':
-            # link
-            if ''.join(c.char for c in chars[pos:pos+2]) == '[[':
-                # possible editoral comment
-                end = find('[[', ']]', pos+2, False)
-                if end == -1:
-                    # oops
-                    raise BadFormat(
-                            "failed to find matching `]]` starting near %r between %r and %r"
-                            % (chars[pos-10:pos+10], parent.start_line, parent.end_line))
-                chars[start+1:end+1] = format(chars[start+2:end], allowed_styles, parent=parent, _recurse=True)
-                pos += 3
-                continue
-            # look for closing bracket and process link
-            end = find('[', ']', start+1, False)
-            if end == -1:
-                # oops
-                raise BadFormat(
-                        "failed to find matching `]` starting near %r between %r and %r"
-                        % (chars[pos-10:pos+10], parent.start_line, parent.end_line))
-            # what kind of link do we have?
-            if chars[start+1].char == '^':
+        if groups and groups[-1][0] == pos:
+            # end of the group; unmatched markers inside it stay as text
+            stop, openers, floor = groups.pop()
+            if char == ']':
+                events.append([pos, 2, TEXT_EVENT, char])
+            pos += 1 + (char == ']')
+            continue
+        if char == '[':
+            # link or footnote
+            stop = pairs[pos]
+            if text.startswith('^', pos+1):
                 # a foot note
-                # remove previous spaces
-                while chars[start-1].char == ' ':
-                    chars.pop(start-1)
-                    start -= 1
-                    end -=1
-                marker = ''.join([c.char for c in chars[start+1:end]])
-                fn = Link(marker=marker, parent=parent)
-                chars[start:end+1] = [fn]
-                pos += 1
+                link = Link(marker=collect(pos+1, stop), parent=parent)
+                link.start, link.end = pos, stop + 1
+                events.append([pos, stop+1-pos, NOTE_EVENT, link])
+                pos = stop + 1
                 continue
-            elif end+1 == len(chars) or peek_char(end+1) not in '[(':
+            label = collect(pos+1, stop)
+            if stop+1 == end or text[stop+1] not in '[(':
                 # either simple wiki page link, or a separately listed url and this
                 # text is also the marker
-                text = ''.join([c.char for c in chars[start+1:end]])
-                link = Link(text=text, url=text, parent=parent)
-                chars[start:end+1] = [link]
-                pos += 1
-                continue
+                link = Link(text=label, url=label, parent=parent)
             else:
-                text = ''.join([c.char for c in chars[start+1:end]])
-                second = end + 2
-                if peek_char(end+1) == '[':
+                second = stop + 2
+                if text[stop+1] == '[':
                     # url is listed separately, save the marker
-                    end = find('[', ']', second, False)
-                    if end == -1:
-                        # oops
-                        raise BadFormat(
-                                "failed to find matching `]` starting near %r between lines %r and %r"
-                                % (chars[pos-10:pos+10], parent.start_line, parent.end_line))
-                    marker = ''.join([c.char for c in chars[second:end]])
-                    link = Link(text=text, marker=marker, parent=parent)
-                    chars[start:end+1] = [link]
-                    pos += 1
-                    continue
+                    stop = pairs[stop+1]
+                    link = Link(text=label, marker=collect(second, stop), parent=parent)
                 else:
                     # url is between ( and )
-                    end = find('(', ')', second, False)
-                    if end == -1:
-                        # oops
-                        raise BadFormat(
-                                "failed to find matching `)` starting near %r between lines %r and %r"
-                                % (chars[pos-10:pos+10], parent.start_line, parent.end_line))
-                    url = ''.join([c.char for c in chars[second:end]])
+                    stop = pairs[stop+1]
+                    url = collect(second, stop)
                     # if text is empty, use the url for it
-                    link = Link(text=text or url, url=url, parent=parent)
-                    chars[start:end+1] = [link]
-                    pos += 1
-                    continue
-        # stars, tildes, underscores, equals, carets
-        if ch.char not in "*~_=^":
-            pos += 1
+                    link = Link(text=label or url, url=url, parent=parent)
+            link.start, link.end = pos, stop + 1
+            span[:] = stop + 1, punct_run(pos)[1]
+            events.append([pos, stop+1-pos, NODE_EVENT, link])
+            pos = stop + 1
             continue
-        single = ch.char
-        double = peek_char(pos, 2)
-        triple = peek_char(pos, 3)
-        if triple == '***':
-            # bold italic
-            marker = '***'
-            ws_needed = True
-        elif double == '**':
-            # bold
-            marker = '**'
-            ws_needed = True
-        elif single == '*':
-            # italic
-            marker = '*'
-            ws_needed = True
-        elif double == '__':
-            # underline
-            marker = '__'
-            ws_needed = True
-        elif double == '==':
-            # highlight
-            marker = '=='
-            ws_needed = True
-        elif double == '~~':
-            # strike-through
-            marker = '~~'
-            ws_needed = True
-        elif single == '~':
-            # subscript
-            marker = '~'
-            ws_needed = False
-        elif single == '^':
-            # superscript
-            marker = '^'
-            ws_needed = False
-        else:
-            # no possible match, continue on
+        if char not in EMPHASIS:
+            # a closer with no opener
             pos += 1
             continue
-        # to be the start of formatting, the previous (non-mark) character must be white space
-        if ws_needed and not ws(pos, forward=False):
-            pos += len(marker)
-            continue
-        # even if preceding white-space is not needed, a succeeding non-whitespace is
-        if not non_ws(pos+len(marker)):
-            pos += len(marker)
-            continue
-        # at this point, we have a valid starting marker, but only if we can find a valid ending marker as well
-        end = find(marker, marker, pos+len(marker), ws_needed)
-        if end == -1:
-            # found nothing
-            pos += len(marker)
-            continue
-        # found something -- does it meet the other criteria?
-        if ws_needed and not ws(end+len(marker)):
-            # failed the white space test
+        # stars, tildes, underscores, equals, carets
+        stop = pos + 1
+        while stop < end and text[stop] == char:
+            stop += 1
+        punct, word_before = punct_run(pos)
+        edge = punct.end()
+        word_after = edge < end and text[edge].isalnum()
+        markers = EMPHASIS[char]
+        # try to close open markers first: an exact fit wins, then a pending sub-
+        # or super-script (which must close at the next marker or not at all),
+        # then the nearest shorter marker
+        while pos < stop:
+            run = stop - pos
+            exact = nearest = pending = None
+            for marker in markers:
+                stack = openers.get(marker)
+                if not stack or len(marker) > run:
+                    continue
+                delimiter = stack[-1]
+                if len(marker) == run:
+                    exact = delimiter
+                if nearest is None or delimiter[0] > nearest[0]:
+                    nearest = delimiter
+                if not MARKER_STYLES[marker].whitespace:
+                    pending = delimiter
+            for found in (exact, pending, nearest):
+                if found is not None and closes(found[3], word_before, word_after):
+                    break
+            else:
+                found = None
+            if pending is not None and found is not pending:
+                openers[pending[3]].pop()
+            if found is None:
+                break
+            # we have matching markers!  anything opened after this one stays as text
+            start, length, action, marker = found
+            for stack in openers.values():
+                while stack and stack[-1][0] >= start:
+                    stack.pop()
+            found[2] = OPEN_EVENT
+            events.append([pos, length, CLOSE_EVENT, marker])
+            pos += length
+        # what's left may start new markers
+        while pos < stop:
+            for marker in markers:
+                if len(marker) <= stop - pos:
+                    break
+            else:
+                marker = char
+            if (
+                    marker in markers and word_after
+                    and (not MARKER_STYLES[marker].whitespace or not word_before)
+                ):
+                delimiter = [pos, len(marker), None, marker]
+                openers.setdefault(marker, []).append(delimiter)
+                events.append(delimiter)
             pos += len(marker)
+    # made it through the string!  now build the nodes
+    result = items = []
+    spans = []
+    string = []
+    # where the pending plain text starts
+    since = pos = 0
+    for offset, length, action, value in events:
+        if action is None:
+            # an emphasis marker that was never matched
             continue
-        # again, even if succedding white-space is not needed,a preceding non-whitespace is
-        if not non_ws(end, forward=False):
-            pos += len(marker)
+        string.append(text[pos:offset])
+        pos = offset + length
+        if action == TEXT_EVENT:
+            string.append(value)
             continue
-        # we have matching markers!
-
-        txt = Text(style=TextType(marker), parent=parent)
-        mask = ~txt.style
-        items = format(chars[start+len(marker):end], allowed_styles, parent=parent, _recurse=True)
-        if False: #len(items) == 1:
-            txt.text = items[0].text
+        if action == NOTE_EVENT:
+            # remove previous spaces
+            while string:
+                string[-1] = string[-1].rstrip(' ')
+                if string[-1]:
+                    break
+                string.pop()
+        flush(items, since, offset)
+        since = pos
+        if action == OPEN_EVENT:
+            if len(spans) == context.max_inline_depth:
+                raise too_deep(offset)
+            txt = Text(style=MARKER_STYLES[value], parent=parent)
+            txt.start = offset
+            items.append(txt)
+            spans.append(txt)
+            items = txt.items
+        elif action == CLOSE_EVENT:
+            txt = spans.pop()
+            txt.end = pos
+            mask = ~txt.style_bits
+            for item in txt.items:
+                item.style_bits &= mask
+            if spans:
+                items = spans[-1].items
+            else:
+                items = result
         else:
-            for item in items:
-                item.style &= mask
-            txt.items = items
+            items.append(value)
+    string.append(text[pos:])
+    flush(items, since, end)
+    if cache is not None:
+        cache.put(key, result)
+    return place(result)
+
+def find_pairs(text, parent):
+    """
+    pair every backtick, parenthesis, and bracket opener in text with its closer
 
-        chars[start:end+len(marker)] = [txt]
-        pos += 1
-        continue
-    # made it through the string!
-    # TODO: condense styles if possible; for now, just return it
+    returns {offset of opener: offset of closer}; an opener without a closer
+    is a BadFormat
 
-    string = []
-    for ch in chars:
-        if ch.text is not None or ch.items:
-            if string:
-                result.append(Text(''.join(string), parent=parent))
-                string = []
-            result.append(ch)
+    code spans, link text, and urls are not markup, so only their own closer
+    is looked for; everything else is paired with a stack
+    """
+    def scan(open, close, start, between='between'):
+        # offset of `close` that balances `open`, skipping escaped characters
+        count = 1
+        regex = CLOSERS[close]
+        found = regex.search(text, start)
+        while found is not None:
+            i = found.start()
+            if text.startswith(close, i):
+                count -= 1
+                if not count or open == close:
+                    return i
+            elif text.startswith(open, i):
+                count += 1
+            found = regex.search(text, found.end())
+        # code closers are quoted with quotes, the others with backticks
+        quote = close.startswith('`') and '"' or '`'
+        raise BadFormat(
+                'failed to find matching %s%s%s starting near %r %s %r and %r'
+                % (quote, close, quote, text[max(0, start-10):start+10], between, parent.start_line, parent.end_line))
+
+    pairs = {}
+    groups = []
+    found = PAIRED.search(text)
+    while found is not None:
+        pos = found.start()
+        char = text[pos]
+        if char == '\\':
+            pos += 2
+        elif char == '`':
+            # code or pre
+            marker = text.startswith('``', pos) and '``' or '`'
+            stop = pairs[pos] = scan(marker, marker, pos+len(marker))
+            pos = stop + len(marker)
+        elif char == '(' or text.startswith('[[', pos):
+            # parenthetical or editorial comment
+            groups.append(pos)
+            pos += 1 + (char == '[')
+        elif char == ')' or text.startswith(']]', pos):
+            if groups and text[groups[-1]] == (char == ')' and '(' or '['):
+                pairs[groups.pop()] = pos
+                pos += 1 + (char == ']')
+            else:
+                pos += 1
+        elif char == '[':
+            # link or footnote
+            stop = pairs[pos] = scan('[', ']', pos+1)
+            if text[pos+1] != '^' and text[stop+1:stop+2] in ('[', '('):
+                # followed by the marker or the url
+                open = text[stop+1]
+                close = (open == '[') and ']' or ')'
+                pairs[stop+1] = scan(open, close, stop+2, 'between lines')
+                stop = pairs[stop+1]
+            pos = stop + 1
         else:
-            string.append(ch.char)
-    if string:
-        result.append(Text(''.join(string), parent=parent))
-    return result
+            pos += 1
+        found = PAIRED.search(text, pos)
+    if groups:
+        start = groups[0]
+        raise BadFormat(
+                "failed to find matching `%s` starting near %r between %r and %r"
+                % ((text[start] == '(') and ')' or ']]', text[max(0, start-10):start+10], parent.start_line, parent.end_line))
+    return pairs
 
 def write_css(target):
     with codecs.open(target, 'w', encoding='utf8') as fh:
         fh.write(default_css)
 
-def write_html(target, doc, title=None, fragment=False, css='stonemark.css'):
-    page = []
-    if isinstance(doc, Document):
-        if not title and doc.title:
-            title = doc.title
-        doc = doc.to_html()
-    if not fragment:
-        page.append(html_page_head)
+def write_html(target, doc, title=None, fragment=False, css='stonemark.css', compact=False):
+    with codecs.open(target, 'w', encoding='utf8') as f:
+        for _ in render_page(f.write, doc, title, fragment, css, compact):
+            pass
+write_file = write_html
+
+def render_page(write, doc, title=None, fragment=False, css='stonemark.css', compact=False):
+    """
+    pass the html page for doc, a Document or its html, to write; yields once the
+    page head is written, and after each of the document's nodes
+    """
+    if isinstance(doc, Document) and not title and doc.title:
+        title = doc.title
+    nl = not compact and '\n' or ''
+    if fragment:
+        # a whole page starts and ends with its tags, but a fragment may not
+        write = strip_writer(write)
+    else:
+        page = [html_page_head]
         if title:
             page.append(html_page_title % title)
         if css:
             page.append(html_page_css % css)
         page.append(html_page_body)
-    page.append(doc)
+        if compact:
+            page = [line.strip() for piece in page for line in piece.split('\n')]
+        write(nl.join(page) + nl)
+        yield
+    if isinstance(doc, Document):
+        for _ in doc.rendering(write, compact):
+            yield
+    else:
+        write(doc)
     if not fragment:
-        page.append(html_page_post)
-    with codecs.open(target, 'w', encoding='utf8') as f:
-        f.write('\n'.join(page).strip())
-write_file = write_html
+        post = html_page_post
+        if compact:
+            post = ''.join(line.strip() for line in post.split('\n'))
+        write(nl + post)
+    yield
 
-class Document(object):
+def newline(margin, indent=0):
+    """
+    return what starts a new line of html, indent spaces past margin -- nothing,
+    for compact html (margin is None)
+    """
+    if margin is None:
+        return ''
+    return '\n' + margin + ' ' * indent
 
-    title = None
+def file_writer(fp, encoding='utf8'):
+    """
+    return a function that writes text to fp, encoding it first if fp is binary
+    """
+    py2 = sys.version_info[0] < 3
+    if isinstance(fp, io.TextIOBase):
+        binary = False
+    elif isinstance(fp, (io.RawIOBase, io.BufferedIOBase)):
+        binary = True
+    elif py2 and isinstance(fp, file):
+        # a python 2 file takes unicode only if it is ascii
+        binary = True
+    else:
+        # anything else is binary if its mode says so, and it has no encoding
+        mode = getattr(fp, 'mode', None)
+        binary = (
+                getattr(fp, 'encoding', None) is None
+                and isinstance(mode, basestring) and 'b' in mode
+                )
+    if binary:
+        def write(text):
+            fp.write(text.encode(encoding))
+        return write
+    if py2:
+        # the html is a mix of str and unicode, and text files take only unicode
+        def write(text):
+            fp.write(unicode(text))
+        return write
+    return fp.write
+
+def strip_writer(write):
+    """
+    return a function that passes text on to write, less the leading and trailing
+    whitespace of all the text together
+    """
+    # trailing whitespace is held back until more text shows it is not at the end;
+    # None until the first text, so leading whitespace is dropped
+    held = [None]
+    def write_stripped(text):
+        body = text.rstrip()
+        if not body:
+            if held[0] is not None:
+                held[0] += text
+            return
+        trailing = text[len(body):]
+        if held[0] is None:
+            body = body.lstrip()
+        else:
+            write(held[0])
+        write(body)
+        held[0] = trailing
+    return write_stripped
 
-    def __init__(self, text, first_header_is_title=False, header_sizes=(1, 2, 3, 4), links=None):
+class ParseContext(object):
+    """
+    what the nodes of one conversion share: the options, the links waiting to be
+    resolved, and the node id counter
+
+    a Document and its sub-documents share a context, and nothing is shared
+    between contexts, so Documents can be created in several threads at once
+    """
+
+    def __init__(self, links=None, max_inline_depth=64, format_cache=None):
         if links is None:
             links = {}
         self.links = links
+        # deepest nesting of emphasis, parentheticals, and editorial comments
+        # allowed in a paragraph, cell, etc.
+        self.max_inline_depth = max_inline_depth
+        # FormatCache to share inline results with other documents, or None
+        self.format_cache = format_cache
+        self.node_ids = count(1)
+
+    def next_id(self):
+        return next(self.node_ids)
+
+
+class Document(object):
+    """
+    the parsed nodes of some StoneMark text, ready to be rendered
+
+    with keep_html, each top-level node keeps its html once rendered, so rendering
+    the document again is nearly free -- at the cost of holding all that html for
+    as long as the document lives, and of calling Node.changed() after changing any
+    node, or the old html is rendered
+    """
+
+    __slots__ = (
+            'context', 'links', 'blocks', 'first_header_is_title', 'header_sizes', 'nodes', 'title',
+            'keep_html',
+            )
+
+    def __init__(
+            self, text, first_header_is_title=False, header_sizes=(1, 2, 3, 4), links=None,
+            max_inline_depth=64, format_cache=None, context=None, keep_html=False,
+        ):
+        if context is None:
+            context = ParseContext(links=links, max_inline_depth=max_inline_depth, format_cache=format_cache)
+        self.context = context
+        self.links = context.links
+        self.title = None
+        self.keep_html = keep_html
         # TODO: use `self.blocks` to enable enforcing lead blank lines for headers
         self.blocks = []
         self.first_header_is_title = first_header_is_title
@@ -1801,15 +2336,27 @@ class Document(object):
                 header_sizes = header_sizes + (header_sizes[2], )
         self.header_sizes = header_sizes
         #
+        self.nodes = []
+        if text is not None:
+            # text can also be a file, any iterable of lines, or a stream
+            if not isinstance(text, PPLCStream):
+                text = PPLCStream(text)
+            run_parsing(self.parsing(text))
+
+    def parsing(self, stream):
+        """
+        read the blocks in stream into nodes, yielding each one to be parsed, and
+        being sent whether to keep it
+        """
         blocks = Detail, CodeBlock, Table, Heading, List, Rule, IDLink, Image, BlockQuote, Paragraph
-        stream = PPLCStream(text)
-        nodes = []
+        nodes = self.nodes
         count = 0
         while stream.skip_blank_lines():
             line = stream.current_line.rstrip()
             next_line = stream.peek_line().rstrip()
+            tags = stream.tags()
             for nt in blocks:
-                match, indent, kwds = nt.is_type(stream.last_line, line, next_line)
+                match, indent, kwds = nt.is_type(stream.last_line, line, next_line, tags)
                 if match:
                     if nodes and nt is List:
                         if indent != 0 and isinstance(nodes[-1], CodeBlock) and nodes[-1].block_type == 'indented':
@@ -1819,22 +2366,429 @@ class Document(object):
                     break
             else:
                 raise FormatError('no match found at line %d\n%r' % (stream.line_no, line))
-            try:
-                keep = node.parse()
-            except Exception as exc:
-                raise
-                raise FormatError('conversion error: %r in\n%r' % (exc.args, node.items))
+            keep = yield node
             if nodes and nt is CodeBlock and node.block_type == 'indented' and isinstance(nodes[-1], List):
                 raise BadFormat('indented code blocks cannot follow lists (line %d)\n%r' % (node.start_line, line))
             if keep:
                 nodes.append(node)
-        self.nodes = nodes
 
-    def to_html(self):
-        result = []
+    def validate(self):
+        """
+        debugging aid: raise AssertionError unless every node, down to the Text in
+        table cells, captions and detail summaries, belongs to this document's context and
+        shares its link table
+        """
+        nodes = list(self.nodes)
+        while nodes:
+            node = nodes.pop()
+            if node.context is not self.context:
+                raise AssertionError('%r is not part of this document' % (node, ))
+            if node.links is not self.links:
+                raise AssertionError('%r does not share the link table' % (node, ))
+            nodes.extend(item for item in node.items if isinstance(item, Node))
+            if isinstance(node, Detail) and node.summary:
+                nodes.extend(item for item in node.summary if isinstance(item, Node))
+            elif isinstance(node, Table):
+                if node.caption:
+                    nodes.extend(node.caption)
+                for rows in (node.header_rows, node.body_rows, node.footer_rows):
+                    for row in rows:
+                        for cell in row:
+                            nodes.extend(cell.text)
+
+    def render(self, write, compact=False):
+        """
+        pass the html for this document to write, a piece at a time
+        """
+        for _ in self.rendering(write, compact):
+            pass
+
+    def rendering(self, write, compact=False):
+        """
+        pass the html for this document to write, yielding after each node
+
+        with keep_html, each node's html is kept with whether it is compact, and
+        used while the document is rendered the same way
+        """
+        renderer = HtmlRenderer(write, compact)
+        separator = ''
         for node in self.nodes:
-            result.append(node.to_html())
-        return '\n\n'.join(result)
+            write(separator)
+            if not renderer.write_kept(self, node):
+                renderer.render(node)
+            separator = not compact and '\n\n' or ''
+            yield
+
+    def iter_html(self, chunk_size=8192, title=None, fragment=False, css='stonemark.css', compact=False):
+        """
+        yield the html page for this document (as write_html() would write it) in
+        chunks of chunk_size characters, as the page is rendered; everything up to
+        the first node is yielded at once, so the page head need not wait, and the
+        last chunk may be short
+        """
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be at least 1, not %r' % (chunk_size, ))
+        # the html not yet yielded, and its length
+        held = []
+        held_size = [0]
+        def write(text):
+            held.append(text)
+            held_size[0] += len(text)
+        def chunks(stop):
+            # yield the first stop characters, and keep the rest
+            text = ''.join(held)
+            for start in range(0, stop, chunk_size):
+                yield text[start:start+chunk_size]
+            held[:] = [text[stop:]]
+            held_size[0] = len(text) - stop
+        first = True
+        for _ in render_page(write, self, title, fragment, css, compact):
+            size = held_size[0]
+            if first:
+                first = False
+                stop = size
+            else:
+                stop = size - size % chunk_size
+            if stop:
+                for chunk in chunks(stop):
+                    yield chunk
+        for chunk in chunks(held_size[0]):
+            yield chunk
+
+    def write_html(self, fp, encoding='utf8', compact=False):
+        """
+        write the html for this document to fp, a text or binary file, as it is
+        made -- the whole of it is never held in memory, unless the document keeps
+        its html
+        """
+        self.render(file_writer(fp, encoding), compact)
+
+    def to_html(self, compact=False):
+        """
+        return the html for this document as one string
+        """
+        html = []
+        self.render(html.append, compact)
+        return ''.join(html)
+
+
+class Renderer(object):
+    """
+    walks a tree of nodes, calling the visit_<type> method for each one
+
+    the method is found along the mro of the node's type (so visit_Text also
+    handles Links, unless there is a visit_Link), and is remembered in a table
+    kept for each renderer class; a type with no method goes to visit_default
+
+    a visit method with nothing in its node to render just writes and returns;
+    otherwise it yields each child where the child's output goes, and is resumed
+    once that child is done -- the suspended methods are kept on a stack, not on
+    Python's, so how deep a tree is does not matter
+    """
+
+    # renderer class -> {node type: visit function}
+    tables = {}
+
+    def __init__(self, write):
+        self.write = write
+        self.table = self.tables.setdefault(self.__class__, {})
+
+    def render(self, node):
+        """
+        pass node (a Node, Cell, or Document) and everything in it to the visit methods
+        """
+        table = self.table
+        visit = table.get(node.__class__) or self.find_visit(node.__class__)
+        children = visit(self, node)
+        # the visit methods waiting on a child, innermost last
+        stack = []
+        while children is not None:
+            for child in children:
+                visit = table.get(child.__class__) or self.find_visit(child.__class__)
+                grandchildren = visit(self, child)
+                if grandchildren is not None:
+                    stack.append(children)
+                    children = grandchildren
+                    break
+            else:
+                children = stack and stack.pop() or None
+
+    def find_visit(self, node_type):
+        """
+        return, and remember, the visit function for node_type
+        """
+        cls = self.__class__
+        for base in node_type.__mro__:
+            visit = getattr(cls, 'visit_' + base.__name__, None)
+            if visit is not None:
+                break
+        else:
+            visit = cls.visit_default
+        self.table[node_type] = visit
+        return visit
+
+    def visit_default(self, node):
+        raise TypeError('%s cannot render %r' % (self.__class__.__name__, node))
+
+    def visit_Document(self, doc):
+        for node in doc.nodes:
+            yield node
+
+
+class HtmlRenderer(Renderer):
+    """
+    renders nodes as html -- what to_html() uses
+
+    margin is written after every new-line, so each line of nested html is
+    indented as it is written, and never has to be split and joined again; it is
+    None for compact html, with no new-lines or indentation that are only there
+    to make the html easier to read
+    """
+
+    def __init__(self, write, compact=False):
+        super(HtmlRenderer, self).__init__(write)
+        self.margin = None if compact else ''
+        # how far a list is indented, set by the list item it is nested in
+        self.list_indent = 0
+
+    def visit_Document(self, doc):
+        separator = ''
+        for node in doc.nodes:
+            self.write(separator)
+            if not self.write_kept(doc, node):
+                yield node
+            separator = newline(self.margin) * 2
+
+    def write_kept(self, doc, node):
+        """
+        write node's kept html (keeping it first, if need be) and return True; or
+        return False if doc does not keep html, or this is a subclass, whose html
+        may not be what was kept
+        """
+        if not doc.keep_html or self.__class__ is not HtmlRenderer:
+            return False
+        compact = self.margin is None
+        kept = node.html
+        if kept is None or kept[0] != compact:
+            node.html = kept = compact, node.to_html(compact)
+        self.write(kept[1])
+        return True
+
+    def visit_Heading(self, heading):
+        self.write('<h%d>' % heading.level)
+        for txt in heading.items:
+            yield txt
+        self.write('</h%d>' % heading.level)
+
+    def visit_Paragraph(self, paragraph):
+        self.write('<p>')
+        for txt in paragraph.items:
+            yield txt
+        self.write('</p>')
+
+    def visit_CodeBlock(self, code):
+        pre = '<pre>'
+        tag = '<code>'
+        if code.attrs:
+            pre = '<pre class="%s">' % code.attrs
+        if code.language:
+            tag = '<code class="language-%s">' % code.language
+        body = escape('\n'.join(code.items))
+        if self.margin:
+            body = body.replace('\n', '\n' + self.margin)
+        self.write(pre + tag)
+        self.write(body)
+        self.write('</code></pre>')
+
+    def visit_Image(self, image):
+        # the alt text is rendered here too, into a list of its own
+        write = self.write
+        alt_text = []
+        self.write = alt_text.append
+        for txt in image.items:
+            yield txt
+        self.write = write
+        alt_text = ''.join(alt_text)
+        if alt_text:
+            alt_text = 'alt="%s"' % alt_text
+        title = image.title
+        if title:
+            title = 'title=%s' % title
+        attrs = ('%s %s' % (title, alt_text)).strip()
+        nl = newline(self.margin)
+        if image.link_url is None:
+            self.write('%s<div><img src="%s" %s></div>%s' % (nl, image.image_url, attrs, nl))
+        else:
+            self.write('%s<div><a href="%s"><img src="%s" %s></a></div>%s' % (nl, image.link_url, image.image_url, attrs, nl))
+
+    def visit_List(self, lst):
+        margin = self.margin
+        spacing = '' if margin is None else ' ' * self.list_indent
+        self.list_indent = 0
+        if lst.regex == UL:
+            start = spacing + '<ul>'
+            end = spacing + '</ul>'
+        else:
+            start = spacing + '<ol>'
+            end = spacing + '</ol>'
+        nl = newline(margin)
+        self.write(start)
+        for item in lst.items:
+            self.write(nl + spacing)
+            yield item
+        self.write(nl + end)
+
+    def visit_ListItem(self, item):
+        # the item's own text goes in the <li>, and any lists in it after that
+        indent = self.list_indent
+        spacing = '' if self.margin is None else ' ' * indent
+        self.write('%s<li>' % spacing)
+        for i in item.items:
+            if not isinstance(i, List):
+                self.write(spacing)
+                yield i
+        self.write('%s</li>' % spacing)
+        for i in item.items:
+            if isinstance(i, List):
+                self.write(newline(self.margin) + spacing)
+                self.list_indent = indent + 4
+                yield i
+
+    def visit_Rule(self, rule):
+        self.write('<hr>')
+
+    def visit_Text(self, text):
+        start, end = STYLE_TAGS[text.style_bits]
+        if text.text is None:
+            return self.styled(text, start, end)
+        html = escape(text.text)
+        if self.margin and '\n' in html:
+            html = html.replace('\n', '\n' + self.margin)
+        self.write(start + html + end)
+
+    def styled(self, text, start, end):
+        self.write(start)
+        for txt in text.items:
+            yield txt
+        self.write(end)
+
+    def visit_Link(self, link):
+        html = link.resolve()
+        if self.margin and '\n' in html:
+            html = html.replace('\n', '\n' + self.margin)
+        self.write(html)
+
+    def visit_IDLink(self, link):
+        s_marker = link.marker[1:]
+        self.write('<div class="footnote" id="footnote-%s"><sup>%s</sup>' % (s_marker, s_marker))
+        for item in link.items:
+            if link.type == 'footnote' and not isinstance(item, Text):
+                self.write(newline(self.margin))
+            yield item
+        self.write('</div>')
+
+    def visit_BlockQuote(self, quote):
+        # every line of the quote's contents is indented
+        margin = self.margin
+        inner = None
+        if margin is not None:
+            inner = margin + ' ' * 12
+        mid_space = newline(inner)
+        self.write('<blockquote>')
+        for item in quote.items:
+            self.write(mid_space)
+            if isinstance(item, Node):
+                self.margin = inner
+                yield item
+                self.margin = margin
+            else:
+                self.write(item.replace('\n', mid_space))
+        self.write(newline(margin) + '</blockquote>')
+
+    def visit_Detail(self, detail):
+        nl = newline(self.margin)
+        self.write(nl + '<details>')
+        if detail.summary:
+            self.write(nl + '<summary>')
+            for item in detail.summary:
+                if isinstance(item, Node):
+                    yield item
+                else:
+                    self.write(item.replace('\n', nl))
+            self.write('</summary>')
+        for item in detail.items:
+            self.write(nl)
+            if isinstance(item, Node):
+                yield item
+            else:
+                self.write(item.replace('\n', nl))
+        self.write(nl + '</details>')
+
+    def visit_Table(self, table):
+        margin = self.margin
+        nl = newline(margin)
+        section_nl = newline(margin, 4)
+        row_nl = newline(margin, 8)
+        cell_nl = newline(margin, 12)
+        self.write('<div%s><table>' % table.html_attrs)
+        if table.caption:
+            self.write(section_nl + '<caption>')
+            for t in table.caption:
+                yield t
+            self.write('</caption>')
+        for section, rows in (
+                ('thead', table.header_rows),
+                ('tbody', table.body_rows),
+                ('tfoot', table.footer_rows),
+            ):
+            if rows:
+                self.write('%s<%s>' % (section_nl, section))
+                for row in rows:
+                    self.write(row_nl + '<tr>')
+                    for cell in row:
+                        self.write(cell_nl)
+                        yield cell
+                    self.write(row_nl + '</tr>')
+                self.write('%s</%s>' % (section_nl, section))
+        self.write(nl + '</table></div>')
+
+    def visit_Cell(self, cell):
+        if cell.type == 'header':
+            open_tag = '<th'
+            close_tag = '</th>'
+        else:
+            open_tag = '<td'
+            close_tag = '</td>'
+        classes = []
+        if cell.rowspan:
+            open_tag += ' rowspan="%s"' % cell.rowspan
+            classes.append('merged_rows')
+        if cell.colspan:
+            open_tag += ' colspan="%s"' % cell.colspan
+            classes.append('merged_cols')
+        if classes:
+            open_tag += ' class="%s"' % ' '.join(classes)
+        open_tag += '>'
+        self.write(open_tag)
+        for t in cell.text:
+            yield t
+        self.write(close_tag)
+
+
+def slot_names(cls, _names={}):
+    """
+    return the names in the __slots__ of cls and all its bases
+    """
+    names = _names.get(cls)
+    if names is None:
+        names = []
+        for base in reversed(cls.__mro__):
+            slots = base.__dict__.get('__slots__', ())
+            if isinstance(slots, basestring):
+                slots = (slots, )
+            names.extend(slots)
+        names = _names[cls] = tuple(names)
+    return names
 
 
 def escape(s, quote=True):
@@ -1843,25 +2797,22 @@ def escape(s, quote=True):
     If the optional flag quote is true (the default), the quotation mark
     characters, both double quote (") and single quote (') characters are also
     translated.
+
+    Each character is only replaced if it is there, so a string with nothing
+    to escape is returned as it is, without being copied.
     """
-    s = s.replace("&", "&amp;") # Must be done first!
-    s = s.replace("<", "&lt;")
-    s = s.replace(">", "&gt;")
     if quote:
-        s = s.replace('"', "&quot;")
-        s = s.replace('\'', "&apos;")
+        table = HTML_ESCAPES
+    else:
+        table = HTML_ESCAPES[:3]
+    for char, entity in table:
+        if char in s:
+            s = s.replace(char, entity)
     return s
 
-def UID():
-    i = 0
-    while True:
-        i += 1
-        yield i
-UID = UID()
-match = Var(re.match)
 
-UL = r'(-|\+|\*) (.*)'                                                      # unordered list
-OL = r'(\d+)(\.|\)) (.*)'                                                   # ordered list
+UL = r'(?P<marker>-|\+|\*) (?P<text>.*)'                                    # unordered list
+OL = r'(?P<number>\d+)(?P<marker>\.|\)) (?P<text>.*)'                       # ordered list
 CL = r'( *)?(.*)'                                                           # continuation line
 BQ = r'(>+)'                                                                # block quote
 CB = r'    (.*)'                                                            # code block, indented
@@ -1874,13 +2825,90 @@ ID_LINK = r'^\[(\^?.*?)\]: (.*)'
 EXT_LINK = r'\b\[((?!^).*?)\]\((.*?)\)\b'
 WIKI_LINK = r'\b\[((?!^).*?)\]\b'
 FOOT_NOTE_LINK = r'\[(\^.*?)\]:'
-IMAGE_LINK = r'^!\[([^]]*)]\(([^"]*)(".*")?\)$'
-IMAGE_LINK_DIRECT = r'^\[!\[([^]]*)]\(([^"]*)(".*")?\)\]\((.*)\)$'
-IMAGE_LINK_REFERENCE = r'^\[!\[([^]]*)]\(([^"]*)(".*")?\)\]\[(.*)\]$'
+IMAGE_LINK = r'^!\[(?P<alt_text>[^]]*)]\((?P<url>[^"]*)(?P<title>".*")?\)$'
+IMAGE_LINK_DIRECT = r'^\[!\[(?P<alt_text>[^]]*)]\((?P<url>[^"]*)(?P<title>".*")?\)\]\((?P<link>.*)\)$'
+IMAGE_LINK_REFERENCE = r'^\[!\[(?P<alt_text>[^]]*)]\((?P<url>[^"]*)(?P<title>".*")?\)\]\[(?P<ref>.*)\]$'
+
+# what LineTags can find in a line -- more than one can apply
+BLANK_LINE = 1 << 0                                                         # nothing but whitespace
+TEXT_LINE = 1 << 1                                                          # can start a paragraph
+UNORDERED_LINE = 1 << 2                                                     # UL
+ORDERED_LINE = 1 << 3                                                       # OL
+QUOTE_LINE = 1 << 4                                                         # BQ
+FENCE_LINE = 1 << 5                                                         # FCB
+CODE_LINE = 1 << 6                                                          # CB
+SUMMARY_LINE = 1 << 7                                                       # DTLS
+DETAIL_LINE = 1 << 8                                                        # DTLD
+UNDERLINE_LINE = 1 << 9                                                     # HD
+RULE_LINE = 1 << 10                                                         # HR
+TITLE_LINE = 1 << 11                                                        # ===, with any leading whitespace
+TABLE_LINE = 1 << 12                                                        # |
+ID_LINK_LINE = 1 << 13                                                      # ID_LINK
+IMAGE_LINE = 1 << 14                                                        # IMAGE_LINK*
+PARAGRAPH_ENDS = (                                                          # kinds that end a paragraph
+        UNORDERED_LINE | ORDERED_LINE | CODE_LINE | QUOTE_LINE | FENCE_LINE
+        | SUMMARY_LINE | DETAIL_LINE
+        )
+LINE_STARTS = {                                                             # first character: (kind, pattern), ...
+        '-': (
+            (UNORDERED_LINE, re.compile(UL)), (SUMMARY_LINE, re.compile(DTLS)),
+            (DETAIL_LINE, re.compile(DTLD)), (UNDERLINE_LINE, re.compile(HD)),
+            (RULE_LINE, re.compile(HR)),
+            ),
+        '+': ((UNORDERED_LINE, re.compile(UL)), ),
+        '*': ((UNORDERED_LINE, re.compile(UL)), (RULE_LINE, re.compile(HR))),
+        '>': ((QUOTE_LINE, re.compile(BQ)), ),
+        '`': ((FENCE_LINE, re.compile(FCB)), ),
+        '~': ((FENCE_LINE, re.compile(FCB)), ),
+        '=': ((UNDERLINE_LINE, re.compile(HD)), ),
+        '.': ((UNDERLINE_LINE, re.compile(HD)), ),
+        '|': ((TABLE_LINE, None), ),
+        '[': (
+            (ID_LINK_LINE, re.compile(ID_LINK)), (IMAGE_LINE, re.compile(IMAGE_LINK_DIRECT)),
+            (IMAGE_LINE, re.compile(IMAGE_LINK_REFERENCE)),
+            ),
+        '!': ((IMAGE_LINE, re.compile(IMAGE_LINK)), ),
+        }
+for digit in '0123456789':
+    LINE_STARTS[digit] = ((ORDERED_LINE, re.compile(OL)), )
+del digit
+HEADING_UNDERLINE = re.compile(HD)
 
 NO_MATCH = False, 0, {}
 WHITE_SPACE = ' \t\n'
 MARKS = "*~_^`[]"
+NODE = u'\ufffc'                                                            # stands in for a node in format()
+NODE_EVENT = 'node'                                                         # format() events
+TEXT_EVENT = 'text'
+NOTE_EVENT = 'note'
+OPEN_EVENT = 'open'
+CLOSE_EVENT = 'close'
+ESCAPED = re.compile(r'\\(.)', re.DOTALL)                                   # backslash escape
+HTML_ESCAPES = (                                                            # for escape(); & must be first
+        ('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'), ('"', '&quot;'), ("'", '&apos;'),
+        )
+MARKUP = re.compile(u'[\\\\`()\\[\\]*~_=^\ufffc]')                          # anything format() acts on
+PUNCT_RUN = re.compile(r'(?:[^\w\s]|_)+', re.UNICODE)                       # neither alphanumeric nor whitespace
+PAIRED = re.compile(r'[\\`()\[\]]')                                         # anything find_pairs() acts on
+CLOSERS = {                                                                 # escapes, and candidate closers
+        '`': re.compile(r'\\.|`', re.DOTALL),
+        '``': re.compile(r'\\.|``', re.DOTALL),
+        ']': re.compile(r'\\.|[][]', re.DOTALL),
+        ')': re.compile(r'\\.|[()]', re.DOTALL),
+        }
+EMPHASIS = {                                                                # longest marker first
+        '*': ('***', '**', '*'),
+        '~': ('~~', '~'),
+        '_': ('__', ),
+        '=': ('==', ),
+        '^': ('^', ),
+        }
+MARKER_STYLES = dict(                                                       # emphasis marker: TextType
+        (marker, TextType(marker))
+        for markers in EMPHASIS.values()
+        for marker in markers
+        )
+STYLE_TAGS = StyleTags()                                                    # style bits: (start tags, end tags)
 
 html_page_head = '''\
 <!doctype html>
@@ -11,8 +11,9 @@ from . import Document, write_file, write_css
         header_title=Spec('make first header a title', FLAG, abbrev='title'),
         css=Spec('use specified css file instead of default css settings', OPTION, force_default='stonemark.css'),
         fragment=Spec('do not include <body>, css, etc., in target file', FLAG),
+        compact=Spec('leave out the new-lines and indentation that only make the html readable', FLAG, abbrev='C'),
         )
-def stonemark(source, target, header_sizes, header_title, css, fragment):
+def stonemark(source, target, header_sizes, header_title, css, fragment, compact):
     if not source.exists():
         abort("'%s' does not exist" % source)
     if target == '':
@@ -20,9 +21,8 @@ def stonemark(source, target, header_sizes, header_title, css, fragment):
     elif target.isdir():
         target += source.filename.strip_ext() + '.html'
     with open(source) as f:
-        text = f.read()
-    doc = Document(text, header_sizes=header_sizes, first_header_is_title=header_title)
-    write_file(target, doc, fragment=fragment, css=css)
+        doc = Document(f, header_sizes=header_sizes, first_header_is_title=header_title)
+    write_file(target, doc, fragment=fragment, css=css, compact=compact)
     if css == 'stonemark.css' and not Path.exists(css):
         write_css(css)
 
@@ -0,0 +1,259 @@
+"""
+timings for StoneMark conversions
+
+    python -m stonemark.benchmark punctuation
+    python -m stonemark.benchmark spans
+    python -m stonemark.benchmark cache
+    python -m stonemark.benchmark blocks
+    python -m stonemark.benchmark nesting
+    python -m stonemark.benchmark memory
+    python -m stonemark.benchmark code
+"""
+from __future__ import print_function
+from scription import *
+from . import Document, FormatCache
+import gc
+import sys
+import timeit
+
+SAMPLE = """\
+Section Title
+=============
+
+A paragraph of *prose* with `code`, a [link](http://example.com), and
+a second line that **wraps** around.
+
+- first item
+- second item with ~~strike~~
+    - a nested item
+- third item
+
+1. one
+2. two
+
+> a quote of some
+> length
+
+    indented code block
+    with two lines
+
+```
+fenced code
+```
+
+| name | value |
+| ---- | ----- |
+| a    | 1     |
+| b    | 2     |
+
+--> summary of details
+--| the body of the details
+
+---
+"""
+
+
+def sample(size):
+    """
+    return a document of every kind of block, of about `size` KB
+    """
+    return '\n'.join([SAMPLE] * max(1, size * 1024 // len(SAMPLE)))
+
+
+def report(label, text, repeat, **kwds):
+    """
+    convert text `repeat` times and print the best time, and the time per KB
+    """
+    size = len(text) / 1024.0
+    best = min(timeit.repeat(lambda: Document(text, **kwds).to_html(), number=1, repeat=repeat))
+    echo('%-20s %8.1f KB %10.4f s %10.4f ms/KB' % (label, size, best, best * 1000 / size))
+
+
+@Command(
+        size=Spec('approximate size of each sample, in KB', OPTION, type=int, force_default=64),
+        repeat=Spec('number of conversions to take the best of', OPTION, type=int, force_default=3),
+        )
+def punctuation(size, repeat):
+    """
+    convert paragraphs of urls, emoticons, and ascii art
+    """
+    samples = (
+            ('urls', 'see [the docs](http://example.com/a_b/c-d/~e?f=g&h=i_j*k) and http://x.org/__init__.py'),
+            ('emoticons', 'hey :-) ;^) o_O ^_^ *\\o/* =^.^= :-* ~~~ and ^^ ok'),
+            ('ascii art', '+=*=*=*=*=*=~-~-~-~-~-~_=_=_=_=^=^=^=^=*=*=*=*=*=~-~-~-~-~-~_=_=_=_=^=^=^=^=+'),
+            ('divider', '=-*-' * 64),
+            )
+    for label, line in samples:
+        lines = []
+        length = 0
+        while length < size * 1024:
+            lines.append(line)
+            length += len(line) + 1
+        report(label, '\n'.join(lines), repeat)
+
+
+@Command(
+        size=Spec('size of the largest paragraph, in KB', OPTION, type=int, force_default=256),
+        repeat=Spec('number of conversions to take the best of', OPTION, type=int, force_default=3),
+        )
+def spans(size, repeat):
+    """
+    convert ever larger paragraphs of links and emphasis -- the time per KB should stay flat
+    """
+    line = 'a *b* **c (d)** [e](http://f) __g__ h~2~o [^1] `i` and [[j ==k==]]'
+    kb = 1
+    while kb <= size:
+        count = kb * 1024 // (len(line) + 1)
+        report('%d spans' % (count * 10), ' '.join([line] * count) + '\n\n[^1]: note', repeat)
+        kb *= 4
+
+
+@Command(
+        pages=Spec('number of templated pages to convert', OPTION, type=int, force_default=100),
+        )
+def cache(pages):
+    """
+    convert a templated reference page with and without a shared FormatCache
+    """
+    rows = '\n'.join(
+            '| `option_%d` | *Yes* | No | see [the docs][docs] [^1] |' % i
+            for i in range(100)
+            )
+    page = '%s\n\n[docs]: http://example.com/docs\n[^1]: **boilerplate** footnote\n' % rows
+    report('no cache', page, pages)
+    shared = FormatCache()
+    report('shared cache', page, pages, format_cache=shared)
+    echo(shared)
+
+
+@Command(
+        size=Spec('size of the largest document, in KB', OPTION, type=int, force_default=1024),
+        repeat=Spec('number of conversions to take the best of', OPTION, type=int, force_default=3),
+        )
+def blocks(size, repeat):
+    """
+    convert ever larger documents of headings, lists, quotes, code, tables, etc.
+    """
+    kb = 16
+    while kb <= size:
+        report('%d KB document' % kb, sample(kb), repeat)
+        kb *= 4
+
+
+def nested_lists(depth, size):
+    """
+    return a document of about `size` KB of lists nested `depth` deep, with a
+    code block in the deepest items
+    """
+    lines = []
+    for level in range(depth):
+        indent = '  ' * level
+        lines.append('%s- item at level %d with *some* text' % (indent, level + 1))
+        lines.append('%s  and a second line' % indent)
+    indent = '  ' * depth
+    lines.extend(['', '%s```' % indent, '%sprint(depth)' % indent, '%s```' % indent, ''])
+    tree = '\n'.join(lines)
+    return '\n'.join([tree] * max(1, size * 1024 // len(tree)))
+
+
+def deepest_item(depth, size):
+    """
+    return a document of about `size` KB of lists nested `depth` deep, with nearly
+    all its lines in the deepest item
+    """
+    lines = ['%s- item at level %d' % ('  ' * level, level + 1) for level in range(depth)]
+    line = '%sa line in the deepest item with *some* text' % ('  ' * depth)
+    lines.extend([line] * max(1, size * 1024 // (len(line) + 1)))
+    return '\n'.join(lines)
+
+
+def nested_quotes(depth, size):
+    """
+    return a document of about `size` KB of quotes nested `depth` deep
+    """
+    lines = []
+    for level in range(1, depth + 1):
+        lines.append('%s quote at level %d with **some** text' % ('>' * level, level))
+        lines.append('%s and a second line' % ('>' * level))
+    lines.append('')
+    tree = '\n'.join(lines)
+    return '\n'.join([tree] * max(1, size * 1024 // len(tree)))
+
+
+@Command(
+        depth=Spec('deepest nesting to try', OPTION, type=int, force_default=32),
+        size=Spec('approximate size of each document, in KB', OPTION, type=int, force_default=64),
+        repeat=Spec('number of conversions to take the best of', OPTION, type=int, force_default=3),
+        )
+def nesting(depth, size, repeat):
+    """
+    convert lists and quotes nested ever deeper -- the time per KB should stay flat
+    """
+    level = 1
+    while level <= depth:
+        report('lists %d deep' % level, nested_lists(level, size), repeat)
+        level *= 2
+    level = 1
+    while level <= depth:
+        report('item %d deep' % level, deepest_item(level, size), repeat)
+        level *= 2
+    level = 1
+    while level <= depth:
+        report('quotes %d deep' % level, nested_quotes(level, size), repeat)
+        level *= 2
+
+
+@Command(
+        size=Spec('approximate size of each document, in KB', OPTION, type=int, force_default=256),
+        )
+def memory(size):
+    """
+    report the memory a parsed document keeps, per KB of source
+    """
+    # imported here, as python 2 has no tracemalloc and the other commands run there
+    try:
+        import tracemalloc
+    except ImportError:
+        abort('memory needs tracemalloc, which python %d.%d does not have' % sys.version_info[:2])
+    samples = (
+            ('every block', sample),
+            ('lists 8 deep', lambda size: nested_lists(8, size)),
+            ('quotes 8 deep', lambda size: nested_quotes(8, size)),
+            )
+    for label, make in samples:
+        gc.collect()
+        tracemalloc.start()
+        # the source is made while tracing, so a document that keeps it pays for it
+        text = make(size)
+        kb = len(text) / 1024.0
+        doc = Document(text)
+        del text
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        echo('%-20s %8.1f KB %12d bytes %10d bytes/KB' % (label, kb, used, used / kb))
+        del doc
+
+
+@Command(
+        size=Spec('size of each code block, in KB', OPTION, type=int, force_default=4096),
+        repeat=Spec('number of renderings to take the best of', OPTION, type=int, force_default=5),
+        )
+def code(size, repeat):
+    """
+    render code blocks of several MB, with and without characters to escape
+    """
+    samples = (
+            ('plain code', '    total = compute(index) + offset  # running total'),
+            ('code to escape', '    if a < b and c > d: print("x & y", \'z\')'),
+            )
+    for label, line in samples:
+        lines = [line] * (size * 1024 // (len(line) + 1))
+        # kept html would make every rendering after the first free
+        doc = Document('```\n%s\n```' % '\n'.join(lines), keep_html=False)
+        best = min(timeit.repeat(doc.to_html, number=1, repeat=repeat))
+        echo('%-20s %8.1f KB %10.4f s %10.4f ms/KB' % (label, size, best, best * 1000 / size))
+
+
+if __name__ == '__main__':
+    Run()
@@ -4,8 +4,15 @@ Tests for StoneMark
 
 from __future__ import unicode_literals
 
-from . import PPLCStream
+from . import PPLCStream, SubStream, LineTags, TextType, write_html
+from . import BLANK_LINE, TEXT_LINE, UNORDERED_LINE, ORDERED_LINE, FENCE_LINE, CODE_LINE, RULE_LINE, UNDERLINE_LINE, TITLE_LINE
 from . import *
+from io import BytesIO, StringIO
+import codecs
+import os
+import sys
+import tempfile
+import threading
 from textwrap import dedent
 from unittest import TestCase, main
 
@@ -38,6 +45,74 @@ class TestPPLCStream(TestCase):
         else:
             raise ValueError('EOFError not raised')
 
+    def test_line_sources(self):
+        for sample, lines in (
+                ('', ['\n']),
+                ('one', ['one\n']),
+                ('one\n', ['one\n', '\n']),
+                ('one\n\nthree', ['one\n', '\n', 'three\n']),
+            ):
+            for source in (sample, StringIO(sample), iter(sample.splitlines(True))):
+                stream = PPLCStream(source)
+                found = []
+                while stream:
+                    found.append(stream.current_line)
+                    stream.skip_line()
+                self.assertEqual(found, lines)
+
+    def test_lines_are_read_as_needed(self):
+        def source():
+            yield 'line one\n'
+            yield 'line two\n'
+            raise AssertionError('read too far')
+        stream = PPLCStream(source())
+        self.assertEqual(stream.current_line, 'line one\n')
+        self.assertEqual(stream.peek_line(), 'line two\n')
+
+    def test_sub_stream(self):
+        tags = LineTags('  > a quote')
+        def lines():
+            yield 'a quote', tags.at(4), 4
+            yield '', None, 12
+        stream = SubStream(lines())
+        self.assertEqual(stream.current_line, 'a quote\n')
+        self.assertIs(stream.tags(), tags.at(4))
+        self.assertEqual(stream.peek_line(), '\n')
+        self.assertEqual(stream.line_no, 0)
+        self.assertEqual(stream.offset, 4)
+        stream.skip_line()
+        self.assertEqual(stream.last_line, 'a quote\n')
+        self.assertEqual(stream.tags().kinds, BLANK_LINE)
+        self.assertEqual(stream.offset, 12)
+        stream.skip_line()
+        self.assertFalse(stream)
+
+class TestLineTags(TestCase):
+
+    def test_kinds(self):
+        for line, kinds in (
+                ('', BLANK_LINE),
+                ('plain text', TEXT_LINE),
+                ('- item', TEXT_LINE | UNORDERED_LINE),
+                ('12) item', TEXT_LINE | ORDERED_LINE),
+                ('---', TEXT_LINE | UNDERLINE_LINE | RULE_LINE),
+                ('===', TEXT_LINE | UNDERLINE_LINE | TITLE_LINE),
+                ('  ===', TITLE_LINE),
+                ('      ```python', FENCE_LINE | CODE_LINE),
+                ('    - item', CODE_LINE),
+            ):
+            self.assertEqual(LineTags(line).kinds, kinds, line)
+
+    def test_indented(self):
+        tags = LineTags('      - item')
+        self.assertEqual((tags.spaces, tags.kinds), (6, CODE_LINE))
+        self.assertEqual((tags.at(2).spaces, tags.at(2).kinds), (4, CODE_LINE))
+        self.assertEqual((tags.at(4).spaces, tags.at(4).kinds), (2, 0))
+        self.assertEqual(tags.at(6).kinds, TEXT_LINE | UNORDERED_LINE)
+        self.assertEqual(tags.at(6).matches[UNORDERED_LINE].group('text'), 'item')
+        self.assertIs(tags.at(6), tags.at(6))
+        self.assertEqual(tags.at(8).kinds, TEXT_LINE)
+
 class TestStonemark(TestCase):
     def test_simple_doc_1(self):
         test_doc = dedent("""\
@@ -1365,6 +1440,523 @@ class TestStonemark(TestCase):
                 # doc.to_html(),
                 )
 
+    def test_backslash_inside_emphasis(self):
+        test_doc = dedent("""\
+                *a \\*starred\\* word* and *a \\` tick*
+                """)
+        doc = Document(test_doc)
+        self.assertEqual(doc.to_html(), dedent("""\
+                <p><i>a *starred* word</i> and <i>a ` tick</i></p>
+                """).strip(),
+                )
+
+    def test_unmatched_markers(self):
+        test_doc = dedent("""\
+                call f(*args, **kwds) with *args and **kwds, then H~2~O
+                """)
+        doc = Document(test_doc)
+        self.assertEqual(doc.to_html(), dedent("""\
+                <p>call f(*args, **kwds) with *args and **kwds, then H<sub>2</sub>O</p>
+                """).strip(),
+                )
+
+    def test_plain_runs_are_single_nodes(self):
+        doc = Document('plain text (with a parenthetical) and [[a comment]]\n')
+        self.assertEqual(len(doc.nodes[0].items), 1)
+        self.assertEqual(doc.to_html(), '<p>plain text (with a parenthetical) and [a comment]</p>')
+        doc = Document('plain *and* styled\n')
+        self.assertEqual([t.text for t in doc.nodes[0].items], ['plain ', None, ' styled'])
+
+    def test_markers_in_punctuation(self):
+        test_doc = dedent("""\
+                he said "*stop*" -- *twice*!  a =-*-=-*-= divider and :-* kisses,
+                (*this*) and "(*that*)", **bold**, *italic*; and ~~gone~~.
+                """)
+        expected = (
+                '<p>he said &quot;<i>stop</i>&quot; -- <i>twice</i>!  a =-*-=-*-= divider and :-* kisses, '
+                '(<i>this</i>) and &quot;(<i>that</i>)&quot;, <b>bold</b>, <i>italic</i>; and <del>gone</del>.</p>'
+                )
+        self.assertEqual(Document(test_doc).to_html(), expected)
+
+    def test_markers_after_spans(self):
+        test_doc = dedent("""\
+                a `c`**b** c, a [z]**bold** b, it [z]==word== y, a [x](http://y)*it* b,
+                and a ``m``__u__ b; but x`c`**b** and a **b**`c` d stay as they are.
+
+                [z]: http://z
+                """)
+        expected = (
+                '<p>a <code>c</code><b>b</b> c, a <a href="http://z">z</a><b>bold</b> b, '
+                'it <a href="http://z">z</a><mark>word</mark> y, a <a href="http://y">x</a><i>it</i> b, '
+                'and a <span class="pre">m</span><u>u</u> b; but x<code>c</code>**b** and a **b**<code>c</code> d '
+                'stay as they are.</p>'
+                )
+        self.assertEqual(Document(test_doc).to_html(), expected)
+
+    def test_inline_depth(self):
+        emphasis = '*deep ' * 100 + 'down' + ' deep*' * 100
+        groups = '(' * 100 + 'down' + ')' * 100
+        quoted = '> ' + emphasis
+        for text in (emphasis, groups, quoted):
+            self.assertRaisesRegex(BadFormat, 'nested more than 64 deep', Document, text)
+            self.assertRaisesRegex(BadFormat, 'nested more than 99 deep', Document, text, max_inline_depth=99)
+            Document(text, max_inline_depth=100).to_html()
+        self.assertEqual(
+                Document(groups, max_inline_depth=100).to_html(),
+                '<p>' + groups + '</p>',
+                )
+
+    def test_deep_nesting(self):
+        quotes = '\n'.join('%s level %d' % ('>' * level, level) for level in range(1, 151))
+        html = Document(quotes).to_html()
+        self.assertEqual(html.count('<blockquote>'), 150)
+        self.assertIn('<p>level 150</p>', html)
+        lists = '\n'.join('%s- level %d' % ('  ' * level, level) for level in range(40))
+        lists += '\n\n%s```\n%scode\n%s```' % (('  ' * 40, ) * 3)
+        html = Document(lists).to_html()
+        self.assertEqual(html.count('<ul>'), 40)
+        self.assertIn('<pre><code>code</code></pre>', html)
+        # nested parsing does not recurse either
+        depth = sys.getrecursionlimit() + 100
+        lists = '\n'.join('%s- level %d' % ('  ' * level, level) for level in range(depth))
+        lists += '\n%sdeepest *text*\n\n  back in level 0' % ('  ' * depth, )
+        doc = Document(lists)
+        html = doc.to_html(compact=True)
+        self.assertEqual(html.count('<ul>'), depth)
+        self.assertIn('<li>level %d deepest <i>text</i></li>' % (depth - 1), html)
+        self.assertTrue(html.startswith('<ul><li>level 0<p>back in level 0</p></li><ul>'))
+        self.assertEqual(doc.nodes[0].end, len(lists))
+
+    def test_validate(self):
+        test_doc = dedent("""\
+                Some *text* [^1]
+
+                - an item with `code`
+                    > a quote in it
+                    >> and a deeper one [link][site]
+
+                | one | **two** |
+                | --- | ------- |
+                | [a] | b       |
+
+                --> the *summary*
+                --| the details [^1]
+
+                [site]: http://example.com
+                [^1]: a foot note
+                """)
+        doc = Document(test_doc)
+        doc.validate()
+        detail = doc.nodes[3]
+        self.assertTrue(isinstance(detail, Detail))
+        detail.summary[1].links = {}
+        self.assertRaisesRegex(AssertionError, 'does not share the link table', doc.validate)
+        detail.summary[1].links = doc.links
+        doc.validate()
+        table = doc.nodes[2]
+        self.assertTrue(isinstance(table, Table))
+        table.body_rows[0][0].text[0].context = ParseContext()
+        self.assertRaisesRegex(AssertionError, 'is not part of this document', doc.validate)
+
+    def test_parsed_nodes_are_compact(self):
+        doc = Document(dedent("""\
+                A *paragraph*
+
+                - an item
+                    > a quote
+
+                | a | b |
+
+                ---
+                """))
+        nodes = list(doc.nodes)
+        while nodes:
+            node = nodes.pop()
+            self.assertFalse(hasattr(node, '__dict__'), node)
+            self.assertIs(node.stream, None)
+            nodes.extend(item for item in node.items if isinstance(item, Node))
+            if isinstance(node, Table):
+                self.assertIs(node.rows, None)
+                self.assertFalse(hasattr(node.body_rows[0][0], '__dict__'))
+        self.assertEqual(doc.nodes[-1].items, [])
+
+    def test_source_spans(self):
+        source = dedent("""\
+                Title
+                =====
+
+                some `code` and a [link](http://x.org) that
+                runs *on and on*
+
+                - an **item**
+
+                  > a quote
+
+                ```
+                x = 1
+                ```
+
+                some `code` and a [link](http://x.org) that
+                runs *on and on*
+                """)
+        def spans(nodes):
+            return [source[n.start:n.end] for n in nodes]
+        for cache in (None, FormatCache()):
+            doc = Document(source, format_cache=cache)
+            heading, para, lst, code, again = doc.nodes
+            self.assertEqual(spans(doc.nodes), [
+                    'Title\n=====',
+                    'some `code` and a [link](http://x.org) that\nruns *on and on*',
+                    '- an **item**\n\n  > a quote',
+                    '```\nx = 1\n```',
+                    'some `code` and a [link](http://x.org) that\nruns *on and on*',
+                    ])
+            self.assertEqual(spans(heading.items), ['Title'])
+            for para in (para, again):
+                self.assertEqual(spans(para.items), [
+                        'some ', '`code`', ' and a ', '[link](http://x.org)', ' that\nruns ', '*on and on*',
+                        ])
+                self.assertEqual(spans(para.items[-1].items), ['on and on'])
+            item = lst.items[0]
+            self.assertEqual(spans(item.items), ['an ', '**item**', '> a quote'])
+            self.assertEqual(spans(item.items[-1].items), ['a quote'])
+            self.assertEqual(spans(item.items[-1].items[0].items), ['a quote'])
+            self.assertEqual(code.items, ['x = 1'])
+
+    def test_format_cache(self):
+        test_doc = dedent("""\
+                | Yes | *No* | see [the site][site] and [wiki] [^1] |
+
+                - Yes
+                - *No*
+
+                [site]: %s
+                [wiki]: %s
+                [^1]: %s
+                """)
+        expected = dedent("""\
+                <div><table>
+                    <tbody>
+                        <tr>
+                            <td>Yes</td>
+                            <td><i>No</i></td>
+                            <td>see <a href="%s">the site</a> and <a href="%s">wiki</a><sup><a href="#footnote-1">1</a></sup></td>
+                        </tr>
+                    </tbody>
+                </table></div>
+
+                <ul>
+                <li>Yes</li>
+                <li><i>No</i></li>
+                </ul>
+
+                <div class="footnote" id="footnote-1"><sup>1</sup>%s</div>""")
+        cache = FormatCache(size=8)
+        first = Document(test_doc % ('http://one', 'http://w1', 'first'), format_cache=cache)
+        misses = cache.misses
+        self.assertEqual(cache.hits, 2)
+        second = Document(test_doc % ('http://two', 'http://w2', 'second'), format_cache=cache)
+        self.assertEqual(cache.misses, misses+1)
+        self.assertEqual(second.to_html(), expected % ('http://two', 'http://w2', 'second'))
+        self.assertEqual(first.to_html(), expected % ('http://one', 'http://w1', 'first'))
+        self.assertTrue(cache.hits > 2)
+        self.assertTrue(len(cache) <= 8)
+        cache = FormatCache(size=1)
+        Document('one\n\ntwo\n\none', format_cache=cache)
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (0, 3, 1))
+        Document('one\n\none\n\none', format_cache=cache)
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (3, 3, 1))
+        # results are copied in and out without recursing
+        depth = sys.getrecursionlimit() + 100
+        deep = '*a (' * depth + 'x' + ')*' * depth
+        cache = FormatCache()
+        html = Document(deep, max_inline_depth=2*depth).to_html()
+        self.assertEqual(Document(deep, max_inline_depth=2*depth, format_cache=cache).to_html(), html)
+        self.assertEqual(Document(deep, max_inline_depth=2*depth, format_cache=cache).to_html(), html)
+        self.assertEqual(cache.hits, 1)
+
+    def test_text_styles(self):
+        doc = Document('**a *b* c** and ***d*** ~~e **f ~~g~~**~~')
+        bold, _, bold_italic, _, strike = doc.nodes[0].items
+        self.assertIs(bold.style, TextType.BOLD)
+        self.assertEqual([t.style for t in bold.items], [TextType.PLAIN, TextType.ITALIC, TextType.PLAIN])
+        self.assertIs(bold_italic.style, TextType.BOLD_ITALIC)
+        self.assertEqual(bold_italic.style_bits, 3)
+        self.assertEqual([t.style for t in strike.items], [TextType.PLAIN, TextType.BOLD])
+        self.assertEqual(
+                doc.to_html(),
+                '<p><b>a <i>b</i> c</b> and <b><i>d</i></b> <del>e <b>f <del>g</del></b></del></p>',
+                )
+        txt = Text('x', style=TextType.BOLD|TextType.ITALIC|TextType.SUPER, parent=doc)
+        self.assertEqual(txt.to_html(), '<b><i><sup>x</sup></i></b>')
+        txt.style = TextType.CODE
+        self.assertEqual(txt.style_bits, int(TextType.CODE))
+        self.assertEqual(txt.to_html(), '<code>x</code>')
+
+    def test_document_from_file(self):
+        text = dedent("""\
+                A Title
+                =======
+
+                A paragraph [with a link][1].
+
+                - a list
+                - of two
+
+                > a quote
+
+                ```
+                code
+                ```
+
+                [1]: http://example.com
+                """)
+        expected = Document(text).to_html()
+        self.assertEqual(Document(StringIO(text)).to_html(), expected)
+        self.assertEqual(Document(iter(text.splitlines(True))).to_html(), expected)
+
+    def test_write_html(self):
+        doc = Document(dedent("""\
+                A paragraph with *café* and [a link][1].
+
+                > a quote
+                > > and another
+
+                | a | b |
+
+                [1]: http://example.com
+                """))
+        expected = doc.to_html()
+        text = StringIO()
+        doc.write_html(text)
+        self.assertEqual(text.getvalue(), expected)
+        binary = BytesIO()
+        doc.write_html(binary)
+        self.assertEqual(binary.getvalue(), expected.encode('utf8'))
+        binary = BytesIO()
+        doc.write_html(binary, encoding='latin1')
+        self.assertEqual(binary.getvalue(), expected.encode('latin1'))
+        # anything else is told by its mode, not by writing to it to see
+        class Recorder(object):
+            mode = 'wb'
+            def __init__(self):
+                self.parts = []
+            def write(self, data):
+                self.parts.append(data)
+        recorder = Recorder()
+        doc.write_html(recorder)
+        self.assertEqual(b''.join(recorder.parts), expected.encode('utf8'))
+
+    def test_rendered_html_is_kept(self):
+        text = dedent("""\
+                A *first* paragraph.
+
+                - an item
+                - another with *emphasis*
+
+                > a quote
+                """)
+        # by default nothing is kept, and a change shows up at once
+        doc = Document(text)
+        expected = doc.to_html()
+        doc.write_html(StringIO())
+        self.assertEqual([node.html for node in doc.nodes], [None, None, None])
+        doc.nodes[1].items[1].items[1].items[0].text = 'EMPHASIS'
+        self.assertEqual(doc.to_html(), expected.replace('emphasis', 'EMPHASIS'))
+        doc = Document(text, keep_html=True)
+        para, lst, quote = doc.nodes
+        self.assertEqual(doc.to_html(), expected)
+        self.assertEqual(para.html, (False, '<p>A <i>first</i> paragraph.</p>'))
+        self.assertEqual(doc.to_html(), expected)
+        # nested blocks belong to the node they are in
+        emphasis = lst.items[1].items[1]
+        self.assertIs(emphasis.parent, lst.items[1])
+        self.assertIs(quote.items[0].parent, quote)
+        # a change drops the kept html of the node and everything it is in
+        emphasis.items[0].text = 'EMPHASIS'
+        self.assertEqual(doc.to_html(), expected)
+        emphasis.items[0].changed()
+        self.assertIs(lst.html, None)
+        self.assertIsNot(para.html, None)
+        self.assertEqual(doc.to_html(), expected.replace('emphasis', 'EMPHASIS'))
+
+    def test_compact_html(self):
+        doc = Document(dedent("""\
+                Some *text*.
+
+                - an item
+                  - and another
+
+                > a quote
+                > > ```
+                > > x  =  1
+                > >   y
+                > > ```
+
+                | a | b |
+                """))
+        self.assertEqual(
+                doc.to_html(compact=True),
+                '<p>Some <i>text</i>.</p>'
+                '<ul><li>an item</li><ul><li>and another</li></ul></ul>'
+                '<blockquote><p>a quote</p><blockquote><pre><code>x  =  1\n  y</code></pre></blockquote></blockquote>'
+                '<div><table><tbody><tr><td>a</td><td>b</td></tr></tbody></table></div>'
+                )
+        # the kept html is for the way the document was last rendered
+        self.assertIn('\n', doc.to_html())
+        page = ''.join(doc.iter_html(compact=True))
+        self.assertTrue(page.startswith('<!doctype html><html><head>'), page)
+        self.assertTrue(page.endswith('</div></body></html>'), page)
+
+    def test_iter_html(self):
+        doc = Document('\n\n'.join('paragraph *%d* of many' % i for i in range(200)))
+        chunks = list(doc.iter_html(chunk_size=100, fragment=True))
+        self.assertEqual(''.join(chunks), doc.to_html())
+        self.assertEqual(set(len(c) for c in chunks[1:-1]), set([100]))
+        # the page head is not held back to fill a chunk
+        chunks = list(doc.iter_html(chunk_size=4096, title='Many'))
+        self.assertTrue(chunks[0].startswith('<!doctype html>'))
+        self.assertTrue(chunks[0].endswith('<body>\n'), chunks[0])
+        self.assertEqual(set(len(c) for c in chunks[1:-1]), set([4096]))
+        with tempfile.NamedTemporaryFile(suffix='.html', delete=False) as fh:
+            target = fh.name
+        try:
+            write_html(target, doc, title='Many')
+            with codecs.open(target, encoding='utf8') as fh:
+                self.assertEqual(''.join(chunks), fh.read())
+        finally:
+            os.remove(target)
+
+    def test_renderer(self):
+        class TextRenderer(Renderer):
+            # just the words
+            def visit_Node(self, node):
+                for item in node.items:
+                    self.write(' ')
+                    yield item
+            def visit_Text(self, text):
+                if text.text is None:
+                    return self.visit_Node(text)
+                self.write(text.text)
+        doc = Document(dedent("""\
+                Title
+                =====
+
+                Some *bold **text***.
+
+                - an item
+                  - and another
+
+                | a | b |
+                """))
+        words = []
+        renderer = TextRenderer(words.append)
+        renderer.render(doc)
+        self.assertEqual(''.join(words).split(), 'Title Some bold text . an item and another'.split())
+        # table cells are not nodes, and this renderer has no method for them
+        self.assertRaises(TypeError, renderer.render, doc.nodes[3].body_rows[0][0])
+        html = []
+        HtmlRenderer(html.append).render(doc)
+        self.assertEqual(''.join(html), doc.to_html())
+        # a subclass is used for every node, even in a document that keeps its html
+        class ClassyRenderer(HtmlRenderer):
+            def visit_Paragraph(self, paragraph):
+                self.write('<p class="x">')
+                for txt in paragraph.items:
+                    yield txt
+                self.write('</p>')
+            def visit_Text(self, text):
+                if text.text is not None:
+                    text = Text(text.text.upper(), style=text.style, parent=text.parent)
+                return super(ClassyRenderer, self).visit_Text(text)
+        doc = Document('Some *text*.\n\n![an image](pic.png)', keep_html=True)
+        self.assertEqual(doc.to_html(), '<p>Some <i>text</i>.</p>\n\n\n<div><img src="pic.png" alt="an image"></div>\n')
+        html = []
+        ClassyRenderer(html.append).render(doc)
+        self.assertEqual(
+                ''.join(html),
+                '<p class="x">SOME <i>TEXT</i>.</p>\n\n\n<div><img src="pic.png" alt="AN IMAGE"></div>\n',
+                )
+        # the nodes are walked without recursing, so any depth can be rendered
+        depth = sys.getrecursionlimit() + 100
+        quotes = '\n'.join('%s level %d' % ('>' * level, level) for level in range(1, depth + 1))
+        html = Document(quotes).to_html(compact=True)
+        self.assertEqual(html.count('<blockquote>'), depth)
+        self.assertTrue(html.endswith('<p>level %d</p>%s' % (depth, '</blockquote>' * depth)))
+
+    def test_concurrent_documents(self):
+        texts = [dedent("""\
+                Title %d
+                =======
+
+                A paragraph with *emphasis*, `code`, [a link][site], and a note.[^1]
+
+                - item one
+                    1. nested **%d**
+                - item two
+
+                > quoted [wiki]
+                >> and again
+
+                | a | b |
+                | - | - |
+                | %d | ~~x~~ |
+
+                --> summary %d
+                --| details
+
+                [site]: http://example.com/%d
+                [wiki]: http://wiki.example.com/%d
+                [^1]: note %d
+                """) % ((i, ) * 7) for i in range(8)]
+        serial = [Document(t).to_html() for t in texts]
+        cache = FormatCache(size=16)
+        results = []
+        def convert(offset):
+            found = []
+            for i in range(50):
+                j = (offset + i) % len(texts)
+                found.append((j, Document(texts[j], format_cache=cache).to_html()))
+            results.append(found)
+        threads = [threading.Thread(target=convert, args=(i, )) for i in range(16)]
+        # switch threads as often as possible
+        new_style = hasattr(sys, 'setswitchinterval')
+        if new_style:
+            interval = sys.getswitchinterval()
+            sys.setswitchinterval(1e-6)
+        else:
+            interval = sys.getcheckinterval()
+            sys.setcheckinterval(1)
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            if new_style:
+                sys.setswitchinterval(interval)
+            else:
+                sys.setcheckinterval(interval)
+        self.assertEqual(len(results), 16)
+        for found in results:
+            for j, html in found:
+                self.assertEqual(html, serial[j])
+
+    def test_unbalanced_markup(self):
+        for text, closer in (
+                ('an (unclosed aside', '`\\)`'),
+                ('an [[unclosed comment', '`\\]\\]`'),
+                ('a [link](without end', '`\\)` .* between lines'),
+                ('a [link][without end', '`\\]` .* between lines'),
+                ('some `unclosed code', '"`"'),
+                ('some ``unclosed mono', '"``"'),
+                ('an [unclosed link', '`\\]` .* between 0'),
+            ):
+            with self.assertRaisesRegex(BadFormat, 'failed to find matching %s' % closer):
+                Document(text)
+        # closers without openers are just text
+        self.assertEqual(Document('a) b] c]]').to_html(), '<p>a) b] c]]</p>')
+
     def test_proper_spacing(self):
         test_doc = dedent("""\
                 A paragraph